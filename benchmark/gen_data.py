@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+import argparse
+import os
+import random
+
+
+# Samples share the same order of gene families on chromosomes, so the collinearity could be detected between them.
+# Each family has a random ancestral sequence, copies of a family in samples are mutated from it, the first copy
+# with lower mutation rate than the others. Extra copies are placed next to the first copy (tandem duplication) or
+# at random positions (dispersed duplication). Gene names are <sample>_g<number>.
+def get_opts():
+    groups = argparse.ArgumentParser()
+    groups.add_argument('-o', '--output', help="output directory, list, cds/ and bed/ would be created in it",
+                        required=True)
+    groups.add_argument('-n', '--samples', help="number of samples, default=5", default=5, type=int)
+    groups.add_argument('-f', '--families', help="number of gene families, default=500", default=500, type=int)
+    groups.add_argument('-m', '--max_copies', help="max copies of a family in one sample, default=3", default=3,
+                        type=int)
+    groups.add_argument('-d', '--dup_rate', help="probability of adding each extra copy, default=0.25", default=0.25,
+                        type=float)
+    groups.add_argument('-a', '--tandem_rate', help="probability of an extra copy is a tandem duplication, "
+                                                    "default=0.6", default=0.6, type=float)
+    groups.add_argument('-l', '--loss_rate', help="probability of a family lost in a sample, default=0.1",
+                        default=0.1, type=float)
+    groups.add_argument('-s', '--singletons', help="number of sample specific genes, default=50", default=50,
+                        type=int)
+    groups.add_argument('-c', '--chromosomes', help="number of chromosomes, default=3", default=3, type=int)
+    groups.add_argument('--min_len', help="min length of genes, default=300", default=300, type=int)
+    groups.add_argument('--max_len', help="max length of genes, default=1500", default=1500, type=int)
+    groups.add_argument('--seed', help="random seed, default=1", default=1, type=int)
+    return groups.parse_args()
+
+
+def random_seq(rnd, length):
+    return ''.join(rnd.choice("ACGT") for _ in range(length))
+
+
+def mutate_seq(rnd, seq, rate):
+    seq = list(seq)
+    for _ in range(int(len(seq) * rate)):
+        seq[rnd.randrange(len(seq))] = rnd.choice("ACGT")
+    return ''.join(seq)
+
+
+def generate_data(out_dir, samples=5, families=500, max_copies=3, dup_rate=0.25, tandem_rate=0.6, loss_rate=0.1,
+                  singletons=50, chromosomes=3, min_len=300, max_len=1500, seed=1):
+    # Return list of samples and count of genes of all samples
+    rnd = random.Random(seed)
+    for sub_dir in ["cds", "bed"]:
+        if not os.path.exists(os.path.join(out_dir, sub_dir)):
+            os.makedirs(os.path.join(out_dir, sub_dir))
+    family_seqs = [random_seq(rnd, rnd.randint(min_len, max_len)) for _ in range(families)]
+
+    sample_list = ["S%d" % idx for idx in range(samples)]
+    gene_cnt = 0
+    for smp in sample_list:
+        # Genes are ordered with the families, dispersed copies are inserted to random positions later
+        gene_seqs = []
+        dispersed_seqs = []
+        for family_seq in family_seqs:
+            if rnd.random() < loss_rate:
+                continue
+            gene_seqs.append(mutate_seq(rnd, family_seq, 0.02))
+            for _ in range(max_copies - 1):
+                if rnd.random() >= dup_rate:
+                    continue
+                copy_seq = mutate_seq(rnd, family_seq, 0.08)
+                if rnd.random() < 0.1:
+                    # Truncated copies
+                    copy_seq = copy_seq[:int(len(copy_seq) * 0.7)]
+                if rnd.random() < tandem_rate:
+                    gene_seqs.append(copy_seq)
+                else:
+                    dispersed_seqs.append(copy_seq)
+        dispersed_seqs.extend(random_seq(rnd, rnd.randint(min_len, max_len)) for _ in range(singletons))
+        for seq in dispersed_seqs:
+            gene_seqs.insert(rnd.randint(0, len(gene_seqs)), seq)
+
+        with open(os.path.join(out_dir, "cds", "%s.cds" % smp), 'w') as fcds:
+            with open(os.path.join(out_dir, "bed", "%s.bed" % smp), 'w') as fbed:
+                pos = 0
+                chr_size = (len(gene_seqs) + chromosomes - 1) // chromosomes
+                for idx in range(len(gene_seqs)):
+                    if idx % chr_size == 0:
+                        pos = 0
+                    seq = gene_seqs[idx]
+                    gn = "%s_g%05d" % (smp, idx)
+                    chrn = "%sChr%02d" % (smp, idx // chr_size + 1)
+                    fcds.write(">%s\n" % gn)
+                    for i in range(0, len(seq), 60):
+                        fcds.write("%s\n" % seq[i: i + 60])
+                    fbed.write("%s\t%d\t%d\t%s\n" % (chrn, pos + 1, pos + len(seq), gn))
+                    pos += len(seq) + rnd.randint(100, 5000)
+        gene_cnt += len(gene_seqs)
+
+    with open(os.path.join(out_dir, "list"), 'w') as fout:
+        fout.write("%s\n" % '\n'.join(sample_list))
+    return sample_list, gene_cnt
+
+
+if __name__ == "__main__":
+    opts = get_opts()
+    sample_list, gene_cnt = generate_data(opts.output, opts.samples, opts.families, opts.max_copies, opts.dup_rate,
+                                          opts.tandem_rate, opts.loss_rate, opts.singletons, opts.chromosomes,
+                                          opts.min_len, opts.max_len, opts.seed)
+    print("Generated %d genes of %d samples" % (gene_cnt, len(sample_list)))
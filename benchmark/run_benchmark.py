@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+import argparse
+import hashlib
+import json
+import os
+import platform
+import sys
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+repo_dir = os.path.dirname(bench_dir)
+sys.path.insert(0, repo_dir)
+sys.path.insert(0, bench_dir)
+
+from panpara.job_runner import run_job
+from gen_data import generate_data
+
+
+# Each stage runs in a child process, so its wall time, cpu time and peak memory are measured alone.
+# Stages with the count of items used for throughput
+stage_list = [
+    ["get_seq_with_list", "genes"],
+    ["run_mcscanx", "hits"],
+    ["get_best_match_table_self", "hits"],
+    ["get_best_match_table_cross", "hits"],
+    ["pan_para", "genes"],
+]
+
+
+def get_opts():
+    groups = argparse.ArgumentParser()
+    groups.add_argument('-o', '--output', help="working directory of benchmark", required=True)
+    groups.add_argument('-n', '--samples', help="number of samples, default=5", default=5, type=int)
+    groups.add_argument('-f', '--families', help="number of gene families, default=500", default=500, type=int)
+    groups.add_argument('--seed', help="random seed of data, default=1", default=1, type=int)
+    groups.add_argument('-t', '--thread', help="threads for pan_para, default=2", default="2")
+    groups.add_argument('-s', '--stages', nargs='+', help="stages to run, default is all stages",
+                        default=[stage for stage, _ in stage_list])
+    groups.add_argument('-b', '--baseline', help="baseline file to compare with, default=\"\"", default="")
+    groups.add_argument('--tolerance', help="regression tolerance of time and memory, default=0.2", default=0.2,
+                        type=float)
+    groups.add_argument('--save', help="save results to this file, default=\"\"", default="")
+    groups.add_argument('--run_stage', help=argparse.SUPPRESS, default="")
+    return groups.parse_args()
+
+
+def count_lines(in_file):
+    cnt = 0
+    with open(in_file, 'rb') as fin:
+        for _ in fin:
+            cnt += 1
+    return cnt
+
+
+def get_paths(work_dir):
+    data_dir = os.path.join(work_dir, "data")
+    return {'data': data_dir, 'list': os.path.join(data_dir, "list"), 'cds': os.path.join(data_dir, "cds"),
+            'bed': os.path.join(data_dir, "bed"), 'self_blast1': os.path.join(work_dir, "S0_S0.blast"),
+            'self_blast2': os.path.join(work_dir, "S1_S1.blast"), 'cross_blast': os.path.join(work_dir, "S1_S0.blast"),
+            'all_bed': os.path.join(work_dir, "all.bed"), 'ref': os.path.join(work_dir, "ref", "match")}
+
+
+def prepare_data(work_dir, samples, families, seed):
+    # Generate data and the blast results used by stages, they are reused if the parameters are not changed
+    paths = get_paths(work_dir)
+    param_file = os.path.join(work_dir, "data.json")
+    params = {'samples': samples, 'families': families, 'seed': seed}
+    if os.path.exists(param_file):
+        with open(param_file, 'r') as fin:
+            if json.load(fin) == params:
+                return
+    print("Generating data")
+    generate_data(paths['data'], samples, families, seed=seed)
+    cds_list = [os.path.join(paths['cds'], "S%d.cds" % idx) for idx in range(2)]
+    for qry, ref, out_blast in [[cds_list[0], cds_list[0], paths['self_blast1']],
+                                [cds_list[1], cds_list[1], paths['self_blast2']],
+                                [cds_list[1], cds_list[0], paths['cross_blast']]]:
+        db = os.path.join(work_dir, "blastdb")
+        run_job(["makeblastdb", "-in", ref, "-dbtype", "nucl", "-out", db])
+        run_job(["blastn", "-query", qry, "-db", db, "-out", out_blast, "-outfmt", "6"])
+    with open(paths['all_bed'], 'w') as fout:
+        for idx in range(samples):
+            with open(os.path.join(paths['bed'], "S%d.bed" % idx), 'r') as fin:
+                for line in fin:
+                    fout.write(line)
+    # The paralog table of S0 used as reference of cross comparison
+    from panpara import get_best_match_table
+    bed = os.path.join(paths['bed'], "S0.bed")
+    get_best_match_table(bed, bed, '', paths['self_blast1'], '', 0.8, 0.8, paths['ref'])
+    with open(param_file, 'w') as fout:
+        json.dump(params, fout)
+
+
+def run_stage(stage, work_dir, threads):
+    # Run stage in this process, return the count of items it processed
+    from panpara import get_seq_with_list, run_mcscanx, get_best_match_table
+    paths = get_paths(work_dir)
+    out_dir = os.path.join(work_dir, "out", stage)
+    bed1 = os.path.join(paths['bed'], "S0.bed")
+    bed2 = os.path.join(paths['bed'], "S1.bed")
+    if stage == "get_seq_with_list":
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        get_seq_with_list(paths['cds'], paths['all_bed'], os.path.join(out_dir, "all.cds"))
+        return count_lines(paths['all_bed'])
+    if stage == "run_mcscanx":
+        run_mcscanx(bed1, bed2, paths['cross_blast'], paths['self_blast2'], out_dir)
+        return count_lines(paths['cross_blast']) + count_lines(paths['self_blast2'])
+    if stage == "get_best_match_table_self":
+        get_best_match_table(bed1, bed1, '', paths['self_blast1'], '', 0.8, 0.8, os.path.join(out_dir, "match"))
+        return count_lines(paths['self_blast1'])
+    if stage == "get_best_match_table_cross":
+        get_best_match_table(os.path.join(paths['ref'], "ref.bed"), bed2, os.path.join(paths['ref'], "para.tbl"),
+                             paths['cross_blast'], paths['self_blast2'], 0.8, 0.8, os.path.join(out_dir, "match"))
+        return count_lines(paths['cross_blast']) + count_lines(paths['self_blast2'])
+    if stage == "pan_para":
+        # Run the whole pipeline from scratch
+        if os.path.exists(out_dir):
+            for root, dirs, files in os.walk(out_dir, topdown=False):
+                for name in files:
+                    os.remove(os.path.join(root, name))
+                for name in dirs:
+                    os.rmdir(os.path.join(root, name))
+        stat = run_job([sys.executable, os.path.join(repo_dir, "panpara.py"), "-l", paths['list'], "-s", paths['cds'],
+                        "-b", paths['bed'], "-o", out_dir, "-t", str(threads)],
+                       log=os.path.join(work_dir, "pan_para.log"))
+        if stat['status'] != "ok":
+            print("Fatal error, pan_para failed, see %s" % os.path.join(work_dir, "pan_para.log"), file=sys.stderr)
+            exit(-1)
+        return sum(count_lines(os.path.join(paths['bed'], bed)) for bed in os.listdir(paths['bed']))
+    print("Fatal error, unknown stage %s" % stage, file=sys.stderr)
+    exit(-1)
+
+
+def run_benchmark(work_dir, stages, threads):
+    # Return dict of stage -> dict of wall_time, cpu_time, max_rss (KB), count, unit and throughput
+    result_db = {}
+    for stage, unit in stage_list:
+        if stage not in stages:
+            continue
+        print("Running %s" % stage)
+        cnt_list = []
+        # The resource usage of stage process includes the processes it waited, like blast and pan_para
+        stat = run_job([sys.executable, os.path.abspath(__file__), "-o", work_dir, "-t", str(threads),
+                        "--run_stage", stage], log=os.path.join(work_dir, "%s.log" % stage),
+                       stdout=lambda fin: cnt_list.append(int(fin.read().strip().split('\n')[-1])))
+        if stat['status'] != "ok":
+            print("Fatal error, stage %s failed, see %s" % (stage, os.path.join(work_dir, "%s.log" % stage)))
+            exit(-1)
+        result_db[stage] = {'wall_time': round(stat['wall_time'], 3), 'cpu_time': round(stat['cpu_time'], 3),
+                            'max_rss': stat['max_rss'], 'count': cnt_list[0], 'unit': unit,
+                            'throughput': round(cnt_list[0] / max(stat['wall_time'], 1e-6), 1)}
+    return result_db
+
+
+def get_final_hash(work_dir):
+    # sha1 of final.csv of pan_para stage, the output should be identical to the baseline with the same data
+    final_csv = os.path.join(work_dir, "out", "pan_para", "final.csv")
+    if not os.path.exists(final_csv):
+        return ""
+    with open(final_csv, 'rb') as fin:
+        return hashlib.sha1(fin.read()).hexdigest()
+
+
+def check_baseline_params(baseline, params, threads):
+    # The results are only comparable with a baseline run with the same data and threads
+    if baseline['data'] != params or str(baseline['threads']) != str(threads):
+        print("Fatal error, baseline was run with data %s and %s threads, but this run uses data %s and %s threads" % (
+            json.dumps(baseline['data'], sort_keys=True), baseline['threads'], json.dumps(params, sort_keys=True),
+            threads))
+        exit(-1)
+
+
+def compare_results(result_db, baseline_db, tolerance, final_hash="", base_hash=""):
+    # Print the results with ratios to baseline, return list of regressions. final_hash and base_hash are the sha1
+    # of final.csv of this run and baseline, the output differs if both are set and not equal
+    regression_list = []
+    if final_hash != "" and base_hash != "" and final_hash != base_hash:
+        regression_list.append("final.csv differs from baseline, sha1 %s instead of %s" % (final_hash, base_hash))
+    print("%-28s %10s %10s %12s %14s %8s %8s" % ("stage", "wall(s)", "cpu(s)", "max_rss(MB)", "throughput",
+                                                 "time", "memory"))
+    for stage in result_db:
+        info = result_db[stage]
+        time_ratio = ""
+        rss_ratio = ""
+        if stage in baseline_db:
+            base = baseline_db[stage]
+            time_ratio = info['wall_time'] / max(base['wall_time'], 1e-6)
+            rss_ratio = info['max_rss'] / max(base['max_rss'], 1)
+            if time_ratio > 1 + tolerance:
+                regression_list.append("%s wall time %.2fx of baseline" % (stage, time_ratio))
+            if rss_ratio > 1 + tolerance:
+                regression_list.append("%s peak memory %.2fx of baseline" % (stage, rss_ratio))
+            time_ratio = "%.2fx" % time_ratio
+            rss_ratio = "%.2fx" % rss_ratio
+        print("%-28s %10.2f %10.2f %12.1f %8.1f %-5s %8s %8s" % (
+            stage, info['wall_time'], info['cpu_time'], info['max_rss'] / 1024.0, info['throughput'],
+            info['unit'] + "/s", time_ratio, rss_ratio))
+    return regression_list
+
+
+if __name__ == "__main__":
+    opts = get_opts()
+    work_dir = os.path.abspath(opts.output)
+    # Use the stand-in aligners instead of the installed ones
+    os.environ['PATH'] = os.path.join(bench_dir, "bin") + os.pathsep + os.environ['PATH']
+    if opts.run_stage != "":
+        cnt = run_stage(opts.run_stage, work_dir, opts.thread)
+        print(cnt)
+        exit(0)
+
+    params = {'samples': opts.samples, 'families': opts.families, 'seed': opts.seed}
+    baseline = {'stages': {}, 'final_sha1': ""}
+    if opts.baseline != "":
+        with open(opts.baseline, 'r') as fin:
+            baseline.update(json.load(fin))
+        check_baseline_params(baseline, params, opts.thread)
+
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    prepare_data(work_dir, opts.samples, opts.families, opts.seed)
+    result_db = run_benchmark(work_dir, opts.stages, opts.thread)
+    final_hash = ""
+    if "pan_para" in result_db:
+        final_hash = get_final_hash(work_dir)
+
+    regression_list = compare_results(result_db, baseline['stages'], opts.tolerance, final_hash,
+                                      baseline['final_sha1'])
+    if opts.save != "":
+        with open(opts.save, 'w') as fout:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(), 'data': params,
+                       'threads': opts.thread, 'final_sha1': final_hash, 'stages': result_db}, fout, indent=1)
+    if len(regression_list) != 0:
+        print("Regressions:\n\t%s" % '\n\t'.join(regression_list))
+        exit(1)
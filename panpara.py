@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 import os
 import argparse
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 from panpara import *
 import time
 
@@ -9,33 +10,180 @@ def time_print(info):
     print("\033[32m%s\033[0m %s" % (time.strftime('[%H:%M:%S]', time.localtime(time.time())), info))
 
 
+def get_self_col_cache(outdir, smp, bed, self_blast_key):
+    # Collinearity scores of sample compared with itself are cached by sample and the hash of its inputs,
+    # so they are computed once for all iterations and reruns
+    return os.path.join(outdir, "msx_cache", "%s.%s.col" % (smp, get_step_key([bed], [self_blast_key])))
+
+
+def get_blast_step(iter_path, blast_name, step, blast_key, share_dir, compress=""):
+    # Blasts of a threshold sweep are saved in the shared directory with their keys, so the settings reuse the blasts
+    # with same inputs. Return the blast file, the directory whose manifest records the step, and the step name.
+    # The blast file has the suffix of compress if it is compressed
+    suffix = get_compress_suffix(compress)
+    if share_dir == "":
+        return os.path.join(iter_path, blast_name + suffix), iter_path, step
+    blast_dir = os.path.join(share_dir, "blast")
+    if not os.path.exists(blast_dir):
+        os.makedirs(blast_dir)
+    return os.path.join(blast_dir, "%s.blast%s" % (blast_key, suffix)), blast_dir, blast_key
+
+
+def record_self_blast_steps(self_blast_futures, self_blast_steps, self_blast_keys, recorded):
+    # Record the query self blasts finished successfully in manifest once they are seen done, so they are not run
+    # again on resume even if an earlier iteration failed. recorded is the set of iterations recorded before.
+    # Cancelled jobs are skipped, their exception() raises CancelledError
+    for iter in self_blast_futures:
+        future = self_blast_futures[iter]
+        if iter in recorded or not future.done() or future.cancelled():
+            continue
+        if future.exception() is None:
+            _, step_dir, step = self_blast_steps[iter]
+            set_step_done(step_dir, step, self_blast_keys[iter])
+            recorded.add(iter)
+
+
+def run_query_self_jobs(blast_job, col_job, threads, shards, exact_hash, catalog_file):
+    # Run the query self blast and then the self collinearity of a sample in one worker, so MCScanX starts as soon as
+    # the blast finished instead of waiting behind the other blasts in pool, either of them could be None.
+    # The error of collinearity is returned instead of raised, so the finished blast is still recorded
+    if blast_job is not None:
+        qry, ref, prog, evalue, fmt, num_aln, out_blast, work_dir, blast_filter = blast_job
+        run_blast(qry, ref, prog, evalue, fmt, num_aln, out_blast, threads, blast_filter, work_dir=work_dir,
+                  shards=shards, exact_hash=exact_hash, catalog_file=catalog_file)
+    if col_job is not None:
+        try:
+            get_self_col_scores(*col_job)
+        except (Exception, SystemExit) as err:
+            return err
+    return None
+
+
+def get_run_catalog(outdir, sample_list, bed_dir):
+    # Catalog of genes of all samples is built once and shared by all comparisons
+    catalog_file = os.path.join(outdir, "genes.cat")
+    bed_list = [find_input_file(os.path.join(bed_dir, "%s.bed" % smp)) for smp in sample_list]
+    catalog_key = get_step_key(bed_list, sample_list)
+    if not is_step_done(outdir, "catalog", catalog_key, [catalog_file]):
+        time_print("Building gene catalog")
+        save_gene_catalog(build_gene_catalog(bed_list, sample_list), catalog_file)
+        set_step_done(outdir, "catalog", catalog_key)
+    return catalog_file
+
+
 def get_opts():
     groups = argparse.ArgumentParser()
     groups.add_argument('-l', '--list', help='list file, each row contain one sample name, first row means reference',
                         required=True)
     groups.add_argument('-s', '--cds',
-                        help='cds directory, must exists all samples end with \".cds\", for example: \"sample1.cds\"',
+                        help='cds directory, must exists all samples end with \".cds\", for example: \"sample1.cds\", '
+                             'could be compressed with \".cds.gz\" or \".cds.zst\"',
                         required=True)
     groups.add_argument('-b', '--bed',
-                        help='bed directory, must exists all samples end with \".bed\" , for example: \"sample1.bed\"',
+                        help='bed directory, must exists all samples end with \".bed\" , for example: \"sample1.bed\", '
+                             'could be compressed with \".bed.gz\" or \".bed.zst\"',
                         required=True)
     groups.add_argument('-d', '--iden', help="identity threshold, default=0.8", default=0.8, type=float)
     groups.add_argument('-c', '--coverage', help="the threshold of alignment coverage, default=0.8", default=0.8,
                         type=float)
     groups.add_argument('-o', '--output', help="output directory", required=True)
     groups.add_argument('-t', '--thread', help='threads for running some steps, default=6', default="6")
+    groups.add_argument('--prefilter', help="filter blast hits with identity, coverage and samples before writing "
+                                            "them to disk, the collinearity would be detected with filtered hits",
+                        action='store_true')
+    groups.add_argument('--incremental', help="build blast db only for the genes added to reference in each "
+                                              "iteration, and search the reference through an alias of these dbs, "
+                                              "could not be used with --tree", action='store_true')
+    groups.add_argument('--tree', help="build paralog tables of sample pairs in parallel and merge them "
+                                       "hierarchically instead of adding samples one by one",
+                        action='store_true')
+    groups.add_argument('--in_memory', help="keep reference genes in memory between iterations instead of "
+                                            "loading them from files of previous iteration, could not be used with "
+                                            "--tree", action='store_true')
+    groups.add_argument('--blast_shards', help="split query of each blast into shards with balanced length, and run "
+                                               "blasts of shards at the same time with the threads split among "
+                                               "them, default=1", default=1, type=int)
+    groups.add_argument('--exact_hash', help="resolve genes identical with reference genes by hashes of sequences "
+                                             "with synthetic hits instead of blast, and only blast one of identical "
+                                             "query genes", action='store_true')
+    groups.add_argument('--max_memory', help="MB of memory could be used by blast hits in comparisons, the best "
+                                             "matches are computed with buckets on disk if it is set, default=0 "
+                                             "means no limit", default=0, type=int)
+    groups.add_argument('--compress', help="compress blast outputs and reference cds of tree mode while writing "
+                                           "them, default is not compress", choices=['gzip', 'zstd'], default="")
+    groups.add_argument('--optimize_order', help="choose the reference and the order of samples which keep the "
+                                                 "reference small in early iterations with k-mer sketches of cds, "
+                                                 "the predicted and actual reference sizes are written to "
+                                                 "ref_growth.tsv", action='store_true')
+    groups.add_argument('--pin_ref', help="keep the first sample of list as reference with --optimize_order",
+                        action='store_true')
+    groups.add_argument('--sweep_iden', nargs='+', type=float, default=None,
+                        help="identity thresholds of a sweep, run with each combination of sweep thresholds and share "
+                             "blasts and collinearity among them, --iden is used if only --sweep_cov is set")
+    groups.add_argument('--sweep_cov', nargs='+', type=float, default=None,
+                        help="coverage thresholds of a sweep, --coverage is used if only --sweep_iden is set")
+    groups.add_argument('--profile', help="profile python stages with cprofile or pyinstrument, the results are "
+                                          "saved to profile directory in output directory, default is not profile",
+                        choices=['cprofile', 'pyinstrument'], default="")
     return groups.parse_args()
 
 
-def pan_para(in_list, cds_dir, bed_dir, iden, cov, outdir, threads):
+def get_match_outputs(match_dir):
+    # Files written by comparison, used for metrics
+    return [os.path.join(match_dir, out_file) for out_file in ["para_ref.txt", "para_col.txt", "ref.bed", "delta.bed"]]
+
+
+def init_run_metrics(outdir, profile):
+    init_metrics(os.path.join(outdir, "metrics.jsonl"), profile, os.path.join(outdir, "profile"))
+
+
+def write_run_metrics(outdir):
+    # Stages of the run are written to metrics.json and metrics.tsv
+    write_metrics_report(os.path.join(outdir, "metrics.jsonl"), os.path.join(outdir, "metrics.json"),
+                         os.path.join(outdir, "metrics.tsv"))
+
+
+def pan_para(in_list, cds_dir, bed_dir, iden, cov, outdir, threads, prefilter=False, incremental=False,
+             in_memory=False, profile="", share_dir="", shards=1, exact_hash=False, max_memory=0, compress="",
+             optimize_order=False, pin_ref=False):
+    # share_dir is the directory of gene catalog, blasts and collinearity caches shared by the runs of a threshold
+    # sweep, default is outdir, and the blasts are saved in the directories of iterations.
+    # shards is the count of query shards of each blast running at the same time.
+    # exact_hash resolves the genes identical with reference or previous query genes without blast.
+    # max_memory is the MB of memory could be used by blast hits in comparisons, 0 means no limit.
+    # compress is the method of compressing blast outputs, "gzip" or "zstd", default is not compress.
+    # optimize_order reorders the samples with k-mer sketches to keep the reference small in early iterations, the
+    # first sample is kept as reference if pin_ref is True, see plan_sample_order
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
+    outdir = os.path.abspath(outdir)
+    cache_dir = outdir
+    if share_dir != "":
+        share_dir = os.path.abspath(share_dir)
+        cache_dir = share_dir
+        if not os.path.exists(share_dir):
+            os.makedirs(share_dir)
+    init_run_metrics(outdir, profile)
     cds_dir = os.path.abspath(cds_dir)
     bed_dir = os.path.abspath(bed_dir)
     ref_bed = ""
     tbl = ""
-    ref_cds = ""
+    # The reference cds is not rewritten in each iteration, it is the list of cds files of genes added to reference
+    # in each iteration, and the blast dbs of these files are only used with incremental mode
+    delta_cds_list = []
+    delta_db_list = []
+    # cds of the sample of current iteration, the genes added to reference are extracted from it
+    smp_cds = ""
+    # Reference genes kept in memory with in_memory mode, None means it should be loaded from delta.bed of previous
+    # iterations. In in_memory mode the reference genes are appended to ref.bed and ref.gff of outdir in each
+    # iteration instead of writing ref.bed of each iteration, so the delta.bed files determine the reference
+    ref_state = None
+    delta_bed_list = []
+    state_bed = os.path.join(outdir, "ref.bed")
+    state_gff = os.path.join(outdir, "ref.gff")
+    # Count of reference genes, which is the sum of genes added in each iteration
+    ref_cnt = 0
     # get sample list
     time_print("Loading samples")
     sample_list = []
@@ -44,97 +192,352 @@ def pan_para(in_list, cds_dir, bed_dir, iden, cov, outdir, threads):
             smp = line.strip()
             if len(smp) != 0:
                 sample_list.append(smp)
+    # Predicted and actual count of reference genes of each iteration with optimize_order
+    growth_list = []
+    if optimize_order:
+        time_print("Planning order of samples")
+        smp_cds_list = [find_input_file(os.path.join(cds_dir, "%s.cds" % smp)) for smp in sample_list]
+        sample_list, predicted_list = plan_sample_order(sample_list, smp_cds_list, os.path.join(cache_dir, "plan"),
+                                                        threads, pin_ref)
+        time_print("Order of samples: %s" % ', '.join(sample_list))
+    catalog_file = get_run_catalog(cache_dir, sample_list, bed_dir)
+    catalog = load_gene_catalog(catalog_file)
 
-    for iter in range(1, len(sample_list) + 1):
-        # For each iteration, we need enter each directory, that curdir is use for returning current directory
-        curdir = os.path.abspath(".")
-        time_print("Starting iteration %d" % iter)
-        if iter == 1:
-            smp = sample_list[0]
-
-            cds1 = os.path.join(cds_dir, "%s.cds" % smp)
-            bed1 = os.path.join(bed_dir, "%s.bed" % smp)
-            cds1 = os.path.abspath(cds1)
-            bed1 = os.path.abspath(bed1)
-
-            iter_path = os.path.join(outdir, "iter1_%s_%s" % (smp, smp))
-            iter_path = os.path.abspath(iter_path)
-            if not os.path.exists(iter_path):
-                os.makedirs(iter_path)
-            os.chdir(iter_path)
-
-            blast_file = os.path.join(iter_path, "iter1.blast")
-            if not os.path.exists("blast.ok"):
-                # Self comparison
-                time_print("\trunning blast")
-                run_blast(cds1, cds1, 'blastn', '1e-3', '6', '', blast_file, threads)
-                os.system("touch blast.ok")
-            else:
-                time_print("\tblast finished before, skip")
-
-            # Generate base paralog file
-            match_dir = os.path.join(iter_path, "match")
-            if not os.path.exists("match.ok"):
-                time_print("\tgetting paralogs")
-                get_best_match_table(bed1, bed1, '', blast_file, '', iden, cov, match_dir)
-                os.system("touch match.ok")
-            else:
-                time_print("\tparalogs get before, skip")
-        else:
-            smp = sample_list[iter - 1]
-
-            cds2 = os.path.join(cds_dir, "%s.cds" % smp)
-            bed2 = os.path.join(bed_dir, "%s.bed" % smp)
-            cds2 = os.path.abspath(cds2)
-            bed2 = os.path.abspath(bed2)
-
-            iter_path = os.path.join(outdir, "iter%d_ref%d_%s" % (iter, iter - 1, smp))
-            iter_path = os.path.abspath(iter_path)
-            if not os.path.exists(iter_path):
-                os.makedirs(iter_path)
-            os.chdir(iter_path)
-
-            blast_file = os.path.join(iter_path, "iter%d.blast" % iter)
-            if not os.path.exists("blast.ok"):
-                time_print("\trunning blast")
-                run_blast(cds2, ref_cds, 'blastn', '1e-3', '6', '', blast_file, threads)
-                os.system("touch blast.ok")
+    # Query self blast and self collinearity only depend on the sample itself, so run all of them with a process pool
+    # before the iterations, and the iterations only wait for the blast and MCScanX with the growing reference
+    self_blast_jobs = {}
+    self_blast_keys = {}
+    self_blast_steps = {}
+    col_jobs = {}
+    for iter in range(2, len(sample_list) + 1):
+        smp = sample_list[iter - 1]
+        cds2 = find_input_file(os.path.abspath(os.path.join(cds_dir, "%s.cds" % smp)))
+        bed2 = find_input_file(os.path.abspath(os.path.join(bed_dir, "%s.bed" % smp)))
+        iter_path = os.path.abspath(os.path.join(outdir, "iter%d_ref%d_%s" % (iter, iter - 1, smp)))
+        blast_filter = None
+        if prefilter:
+            blast_filter = [bed2, bed2, iden, cov]
+        self_blast_keys[iter] = get_blast_key([cds2], blast_filter, exact_hash)
+        self_blast_steps[iter] = get_blast_step(iter_path, "iter%d_qry_self.blast" % iter, "qry_self_blast",
+                                                self_blast_keys[iter], share_dir, compress)
+        qry_self_blast_file, step_dir, step = self_blast_steps[iter]
+        self_col_cache = get_self_col_cache(cache_dir, smp, bed2, self_blast_keys[iter])
+        if not os.path.exists(self_col_cache):
+            col_jobs[iter] = [bed2, qry_self_blast_file, os.path.join(iter_path, "msx_self"), self_col_cache]
+        if is_step_done(step_dir, step, self_blast_keys[iter], [qry_self_blast_file]):
+            continue
+        self_blast_jobs[iter] = [cds2, cds2, 'blastn', '1e-3', '6', '', qry_self_blast_file,
+                                 os.path.join(iter_path, "qry_self"), blast_filter]
+
+    pool = None
+    query_self_futures = {}
+    self_blast_futures = {}
+    iter_threads = threads
+    if len(self_blast_jobs) != 0 or len(col_jobs) != 0:
+        # Half of threads for the pool, and the rest for the blast in iterations,
+        # the threads of pool are split among the jobs running together
+        iter_threads = str(max(1, int(threads) // 2))
+        pool_threads = max(1, int(threads) - int(iter_threads))
+        worker_cnt = max(1, min(max(len(self_blast_jobs), len(col_jobs)), pool_threads))
+        pool = ProcessPoolExecutor(max_workers=worker_cnt)
+        time_print("Submitting %d query self blast jobs" % len(self_blast_jobs))
+        # All jobs are submitted before the iterations, so the workers are forked before any pipe of compression is
+        # opened, and never keep the pipes open
+        for iter in sorted(set(self_blast_jobs) | set(col_jobs)):
+            query_self_futures[iter] = pool.submit(call_with_context, {'iteration': iter}, run_query_self_jobs,
+                                                   self_blast_jobs.get(iter), col_jobs.get(iter),
+                                                   str(max(1, pool_threads // worker_cnt)), shards, exact_hash,
+                                                   catalog_file)
+            if iter in self_blast_jobs:
+                self_blast_futures[iter] = query_self_futures[iter]
+
+    # Finished query self blasts are recorded even if an iteration failed, and the queued jobs are cancelled
+    self_blast_recorded = set()
+    try:
+        for iter in range(1, len(sample_list) + 1):
+            time_print("Starting iteration %d" % iter)
+            set_metrics_context(iteration=iter, sample=sample_list[iter - 1])
+            record_self_blast_steps(self_blast_futures, self_blast_steps, self_blast_keys, self_blast_recorded)
+            if iter == 1:
+                smp = sample_list[0]
+
+                cds1 = os.path.join(cds_dir, "%s.cds" % smp)
+                bed1 = os.path.join(bed_dir, "%s.bed" % smp)
+                cds1 = find_input_file(os.path.abspath(cds1))
+                bed1 = find_input_file(os.path.abspath(bed1))
+
+                iter_path = os.path.join(outdir, "iter1_%s_%s" % (smp, smp))
+                iter_path = os.path.abspath(iter_path)
+                if not os.path.exists(iter_path):
+                    os.makedirs(iter_path)
+
+                smp_cds = cds1
+                blast_filter = None
+                if prefilter:
+                    blast_filter = [bed1, bed1, iden, cov]
+                blast_key = get_blast_key([cds1], blast_filter, exact_hash)
+                blast_file, step_dir, step = get_blast_step(iter_path, "iter1.blast", "blast", blast_key, share_dir,
+                                                            compress)
+                if not is_step_done(step_dir, step, blast_key, [blast_file]):
+                    # Self comparison
+                    time_print("\trunning blast")
+                    run_blast(cds1, cds1, 'blastn', '1e-3', '6', '', blast_file, iter_threads, blast_filter,
+                              work_dir=iter_path, shards=shards, exact_hash=exact_hash, catalog_file=catalog_file)
+                    set_step_done(step_dir, step, blast_key)
+                else:
+                    time_print("\tblast finished before, skip")
+
+                # Generate base paralog file
+                match_dir = os.path.join(iter_path, "match")
+                self_col_cache = get_self_col_cache(cache_dir, smp, bed1, blast_key)
+                match_key = get_step_key([bed1], [blast_key, iden, cov])
+                match_out_list = [os.path.join(match_dir, "para.tbl"), os.path.join(match_dir, "ref.bed")]
+                if not is_step_done(iter_path, "match", match_key, match_out_list):
+                    time_print("\tgetting paralogs")
+                    if in_memory:
+                        ref_state = init_ref_state(state_bed, state_gff)
+                    with stage("best_match", inputs=[bed1, blast_file], outputs=get_match_outputs(match_dir),
+                               profile=True):
+                        get_best_match_table(bed1, bed1, '', blast_file, '', iden, cov, match_dir, ref_state,
+                                             self_col_cache, catalog, max_memory)
+                    set_step_done(iter_path, "match", match_key)
+                else:
+                    time_print("\tparalogs get before, skip")
+                    ref_state = None
             else:
-                time_print("\tblast finished before, skip")
-
-            qry_self_blast_file = os.path.join(iter_path, "iter%d_qry_self.blast" % iter)
-            if not os.path.exists("qry_self_blast.ok"):
-                time_print("\trunning query self blast")
-                run_blast(cds2, cds2, 'blastn', '1e-3', '6', '', qry_self_blast_file, threads)
-                os.system("touch qry_self_blast.ok")
-            # Gerenate paralog file
-            match_dir = os.path.join(iter_path, "match")
-            if not os.path.exists("match.ok"):
-                time_print("\tgetting paralogs")
-                get_best_match_table(ref_bed, bed2, tbl, blast_file, qry_self_blast_file, iden, cov, match_dir)
-                os.system("touch match.ok")
+                smp = sample_list[iter - 1]
+
+                cds2 = os.path.join(cds_dir, "%s.cds" % smp)
+                bed2 = os.path.join(bed_dir, "%s.bed" % smp)
+                cds2 = find_input_file(os.path.abspath(cds2))
+                bed2 = find_input_file(os.path.abspath(bed2))
+
+                iter_path = os.path.join(outdir, "iter%d_ref%d_%s" % (iter, iter - 1, smp))
+                iter_path = os.path.abspath(iter_path)
+                if not os.path.exists(iter_path):
+                    os.makedirs(iter_path)
+
+                smp_cds = cds2
+                blast_filter = None
+                if prefilter:
+                    blast_filter = [ref_bed, bed2, iden, cov]
+                if in_memory:
+                    blast_key = get_blast_key([cds2] + delta_cds_list, blast_filter, exact_hash,
+                                              delta_bed_list + [bed2])
+                else:
+                    blast_key = get_blast_key([cds2] + delta_cds_list, blast_filter, exact_hash)
+                blast_file, step_dir, step = get_blast_step(iter_path, "iter%d.blast" % iter, "blast", blast_key,
+                                                            share_dir, compress)
+                if not is_step_done(step_dir, step, blast_key, [blast_file]):
+                    time_print("\trunning blast")
+                    # Use all threads once all jobs of pool finished
+                    if all(future.done() for future in query_self_futures.values()):
+                        iter_threads = threads
+                    if incremental:
+                        ref_db = os.path.join(iter_path, "refdb")
+                        make_alias_db(delta_db_list, 'blastn', ref_db)
+                        run_blast(cds2, delta_cds_list, 'blastn', '1e-3', '6', '', blast_file, iter_threads,
+                                  blast_filter, ref_db, iter_path, shards, exact_hash, catalog_file)
+                    else:
+                        run_blast(cds2, delta_cds_list, 'blastn', '1e-3', '6', '', blast_file, iter_threads,
+                                  blast_filter, work_dir=iter_path, shards=shards, exact_hash=exact_hash,
+                                  catalog_file=catalog_file)
+                    set_step_done(step_dir, step, blast_key)
+                else:
+                    time_print("\tblast finished before, skip")
+
+                qry_self_blast_file, step_dir, step = self_blast_steps[iter]
+                if iter in query_self_futures:
+                    time_print("\twaiting for query self blast and collinearity")
+                    with stage("wait_query_self"):
+                        col_error = query_self_futures[iter].result()
+                    record_self_blast_steps(self_blast_futures, self_blast_steps, self_blast_keys, self_blast_recorded)
+                    if col_error is not None:
+                        raise col_error
+                else:
+                    time_print("\tquery self blast and collinearity finished before, skip")
+                # Gerenate paralog file
+                match_dir = os.path.join(iter_path, "match")
+                self_col_cache = get_self_col_cache(cache_dir, smp, bed2, self_blast_keys[iter])
+                # The table of previous iteration is determined by its match key
+                if in_memory:
+                    match_key = get_step_key([bed2] + delta_bed_list, [blast_key, self_blast_keys[iter], match_key,
+                                                                       iden, cov])
+                    match_out_list = [os.path.join(match_dir, "para.tbl"), os.path.join(match_dir, "delta.bed")]
+                else:
+                    match_key = get_step_key([bed2, ref_bed], [blast_key, self_blast_keys[iter], match_key, iden,
+                                                               cov])
+                    match_out_list = [os.path.join(match_dir, "para.tbl"), os.path.join(match_dir, "ref.bed")]
+                if not is_step_done(iter_path, "match", match_key, match_out_list):
+                    time_print("\tgetting paralogs")
+                    if in_memory and ref_state is None:
+                        ref_state = load_ref_state(delta_bed_list, catalog, state_bed, state_gff)
+                    with stage("best_match", inputs=[ref_bed, bed2, blast_file, qry_self_blast_file],
+                               outputs=get_match_outputs(match_dir), profile=True):
+                        get_best_match_table(ref_bed, bed2, tbl, blast_file, qry_self_blast_file, iden, cov, match_dir,
+                                             ref_state, self_col_cache, catalog, max_memory)
+                    set_step_done(iter_path, "match", match_key)
+                else:
+                    time_print("\tparalogs get before, skip")
+                    if ref_state is not None:
+                        add_ref_bed(ref_state, catalog, os.path.join(match_dir, "delta.bed"))
+
+            # Get ref.bed, tbl, and cds of genes added to reference for next iteration
+            ref_bed = os.path.join(match_dir, "ref.bed")
+            if in_memory:
+                ref_bed = state_bed
+            tbl = os.path.join(match_dir, "para.tbl")
+            delta_bed = os.path.join(match_dir, "delta.bed")
+            delta_cds = os.path.join(match_dir, "delta.cds")
+            delta_bed_list.append(delta_bed)
+            if optimize_order:
+                with open(delta_bed, 'r') as fin:
+                    ref_cnt += sum(1 for _ in fin)
+                growth_list.append([iter, sample_list[iter - 1], round(predicted_list[iter - 1]), ref_cnt])
+                time_print("\treference genes: %d, predicted %d" % (ref_cnt, round(predicted_list[iter - 1])))
+
+            newcds_key = get_step_key([delta_bed, smp_cds], [])
+            if not is_step_done(iter_path, "newcds", newcds_key, [delta_cds]):
+                time_print("\twriting new cds")
+                get_seq_with_list(cds_dir, delta_bed, delta_cds, [sample_list[iter - 1]])
+                set_step_done(iter_path, "newcds", newcds_key)
             else:
-                time_print("\tparalogs get before, skip")
+                time_print("\tnew cds generated before, skip")
+
+            if os.path.getsize(delta_cds) != 0:
+                delta_cds_list.append(delta_cds)
+                if incremental:
+                    # Only the genes added to reference need a new blast db, the reference is an alias of all these dbs
+                    delta_db = os.path.join(match_dir, "deltadb")
+                    deltadb_key = get_step_key([delta_cds], [])
+                    if not is_step_done(iter_path, "deltadb", deltadb_key):
+                        time_print("\tbuilding blast db of new cds")
+                        make_blast_db(delta_cds, 'blastn', delta_db, os.path.join(match_dir, "makeblastdb.log"))
+                        set_step_done(iter_path, "deltadb", deltadb_key)
+                    else:
+                        time_print("\tblast db of new cds built before, skip")
+                    delta_db_list.append(delta_db)
+
+            # The reference cds of next iteration is the concatenation of files in this list
+            with open(os.path.join(match_dir, "ref.cds.list"), 'w') as fout:
+                fout.write("%s\n" % '\n'.join(delta_cds_list))
+        if in_memory and ref_state is None:
+            # All comparisons were finished before, ref.bed and ref.gff are written with all delta.bed files
+            load_ref_state(delta_bed_list, catalog, state_bed, state_gff)
+    finally:
+        if pool is not None:
+            # The running jobs are waited, so they are recorded after shutdown
+            pool.shutdown(cancel_futures=True)
+            record_self_blast_steps(self_blast_futures, self_blast_steps, self_blast_keys, self_blast_recorded)
+    catalog.close()
+
+    # Get final result
+    time_print("Getting final result")
+    final_tbl = os.path.join(outdir, "final.csv")
+    set_metrics_context(iteration=None, sample=None)
+    export_para_table(tbl, final_tbl)
+    write_run_metrics(outdir)
+    if optimize_order:
+        with open(os.path.join(outdir, "ref_growth.tsv"), 'w') as fout:
+            fout.write("#iteration\tsample\tpredicted_ref\tactual_ref\n")
+            for iter, smp, predicted, actual in growth_list:
+                fout.write("%d\t%s\t%d\t%d\n" % (iter, smp, predicted, actual))
+
+    time_print("Finished")
+
+
+def sweep_pan_para(in_list, cds_dir, bed_dir, iden_list, cov_list, outdir, threads, prefilter=False,
+                   incremental=False, in_memory=False, profile="", shards=1, exact_hash=False, max_memory=0,
+                   compress="", optimize_order=False, pin_ref=False):
+    # Run pan_para with each combination of thresholds in its own directory, the gene catalog, blasts, parsed hits
+    # and self collinearity are shared through the shared directory, so only the steps depending on the reference
+    # are run again for each setting. The counts of families of all settings are written to sweep.tsv
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    outdir = os.path.abspath(outdir)
+    share_dir = os.path.join(outdir, "shared")
+    stats_list = []
+    for iden in iden_list:
+        for cov in cov_list:
+            setting = "iden%s_cov%s" % (iden, cov)
+            time_print("Running setting %s" % setting)
+            setting_dir = os.path.join(outdir, setting)
+            pan_para(in_list, cds_dir, bed_dir, iden, cov, setting_dir, threads, prefilter, incremental, in_memory,
+                     profile, share_dir, shards, exact_hash, max_memory, compress, optimize_order, pin_ref)
+            stats_list.append([iden, cov, setting, get_table_stats(os.path.join(setting_dir, "final.csv"))])
 
-        # Get ref.bed, tbl, ref.cds for next iteration
-        ref_bed = os.path.join(match_dir, "ref.bed")
-        tbl = os.path.join(match_dir, "para.csv")
-        ref_cds = os.path.join(match_dir, "ref.cds")
+    field_list = ['families', 'genes', 'multi_gene', 'core', 'max_size']
+    with open(os.path.join(outdir, "sweep.tsv"), 'w') as fout:
+        fout.write("#iden\tcov\t%s\tfinal\n" % '\t'.join(field_list))
+        for iden, cov, setting, stats in stats_list:
+            fout.write("%s\t%s\t%s\t%s\n" % (iden, cov, '\t'.join(str(stats[key]) for key in field_list),
+                                             os.path.join(setting, "final.csv")))
+    for iden, cov, setting, stats in stats_list:
+        time_print("%s: %s" % (setting, ', '.join("%s=%d" % (key, stats[key]) for key in field_list)))
+    time_print("Finished sweep")
 
-        if not os.path.exists("newcds.ok"):
-            # Generate ref.cds for next iteration
-            time_print("\twriting new cds")
-            get_seq_with_list(cds_dir, ref_bed, ref_cds)
-            os.system("touch newcds.ok")
-        else:
-            time_print("\tnew cds generated before, skip")
 
-        os.chdir(curdir)
+def tree_pan_para(in_list, cds_dir, bed_dir, iden, cov, outdir, threads, prefilter=False, profile="", shards=1,
+                  exact_hash=False, max_memory=0, compress=""):
+    # Paralog tables of samples are built and merged with a binary tree, the nodes whose children finished are run
+    # in a process pool, so the depth of dependent steps is log2 of sample count
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    outdir = os.path.abspath(outdir)
+    init_run_metrics(outdir, profile)
+    cds_dir = os.path.abspath(cds_dir)
+    bed_dir = os.path.abspath(bed_dir)
+    time_print("Loading samples")
+    sample_list = []
+    with open(in_list, 'r') as fin:
+        for line in fin:
+            smp = line.strip()
+            if len(smp) != 0:
+                sample_list.append(smp)
+    catalog_file = get_run_catalog(outdir, sample_list, bed_dir)
+
+    node_list = get_merge_tree(sample_list)
+    worker_cnt = max(1, min(len(sample_list), int(threads)))
+    pool = ProcessPoolExecutor(max_workers=worker_cnt)
+    futures = {}
+    match_dirs = {}
+    # The queued nodes are cancelled and the running ones are waited if a node failed
+    try:
+        while len(match_dirs) < len(node_list):
+            # Submit nodes whose children finished, the threads are split among the unfinished nodes
+            for idx in range(len(node_list)):
+                node = node_list[idx]
+                if idx in futures or any(child not in match_dirs for child in node['children']):
+                    continue
+                job_threads = str(max(1, int(threads) // min(worker_cnt, len(node_list) - len(match_dirs))))
+                node_dir = os.path.join(outdir, "tree", node['name'])
+                if len(node['children']) == 0:
+                    time_print("Submitting self comparison of %s" % node['samples'][0])
+                    futures[idx] = pool.submit(call_with_context, {'iteration': node['name']}, run_tree_leaf,
+                                               node['samples'][0], cds_dir, bed_dir, iden, cov, node_dir, job_threads,
+                                               prefilter, catalog_file, shards, exact_hash, max_memory, compress)
+                else:
+                    left, right = node['children']
+                    time_print("Submitting merge of %s and %s" % (node_list[left]['name'], node_list[right]['name']))
+                    futures[idx] = pool.submit(call_with_context, {'iteration': node['name']}, run_tree_merge, cds_dir,
+                                               match_dirs[left], match_dirs[right], iden, cov, node_dir, job_threads,
+                                               prefilter, catalog_file, shards, exact_hash, max_memory, compress,
+                                               node['samples'])
+            running = [futures[idx] for idx in futures if idx not in match_dirs]
+            wait(running, return_when=FIRST_COMPLETED)
+            for idx in futures:
+                if idx not in match_dirs and futures[idx].done():
+                    match_dirs[idx] = futures[idx].result()
+                    time_print("%s finished" % node_list[idx]['name'])
+    finally:
+        pool.shutdown(cancel_futures=True)
 
     # Get final result
     time_print("Getting final result")
     final_tbl = os.path.join(outdir, "final.csv")
-    os.system("cp %s %s" % (tbl, final_tbl))
+    export_para_table(os.path.join(match_dirs[len(node_list) - 1], "para.tbl"), final_tbl)
+    write_run_metrics(outdir)
 
     time_print("Finished")
 
@@ -148,4 +551,29 @@ if __name__ == '__main__':
     cov = opts.coverage
     outdir = opts.output
     threads = opts.thread
-    pan_para(in_list, cds_dir, bed_dir, iden, cov, outdir, threads)
+    prefilter = opts.prefilter
+    incremental = opts.incremental
+    in_memory = opts.in_memory
+    profile = opts.profile
+    if opts.sweep_iden is not None or opts.sweep_cov is not None:
+        if opts.tree:
+            print("Fatal error, --tree could not be used with threshold sweep")
+            exit(-1)
+        iden_list = opts.sweep_iden if opts.sweep_iden is not None else [iden]
+        cov_list = opts.sweep_cov if opts.sweep_cov is not None else [cov]
+        sweep_pan_para(in_list, cds_dir, bed_dir, iden_list, cov_list, outdir, threads, prefilter, incremental,
+                       in_memory, profile, opts.blast_shards, opts.exact_hash, opts.max_memory, opts.compress,
+                       opts.optimize_order, opts.pin_ref)
+    elif opts.tree:
+        if opts.optimize_order:
+            print("Fatal error, --optimize_order could not be used with --tree")
+            exit(-1)
+        if incremental or in_memory:
+            print("Fatal error, --incremental and --in_memory could not be used with --tree")
+            exit(-1)
+        tree_pan_para(in_list, cds_dir, bed_dir, iden, cov, outdir, threads, prefilter, profile, opts.blast_shards,
+                      opts.exact_hash, opts.max_memory, opts.compress)
+    else:
+        pan_para(in_list, cds_dir, bed_dir, iden, cov, outdir, threads, prefilter, incremental, in_memory, profile,
+                 shards=opts.blast_shards, exact_hash=opts.exact_hash, max_memory=opts.max_memory,
+                 compress=opts.compress, optimize_order=opts.optimize_order, pin_ref=opts.pin_ref)
@@ -1,3 +1,13 @@
 from .get_best_match_table import *
 from .get_cds_with_bed import *
 from .run_blast import *
+from .step_cache import *
+from .para_table import *
+from .job_runner import *
+from .merge_para_table import *
+from .tree_merge import *
+from .metrics import *
+from .gene_catalog import *
+from .blast_hits import *
+from .compress import *
+from .sample_order import *
@@ -0,0 +1,213 @@
+import json
+import mmap
+import os
+import shutil
+from array import array
+from .compress import open_file
+from .metrics import stage
+
+
+# Binary file of blast hits:
+#   magic line
+#   header line, json of count of hits, size and modified time of blast file, and key of gene catalog
+#   columns of query id, subject id, identity, alignment length and bitscore, each is an array of 8 bytes values
+_magic = b"PANPARA_BLAST_HITS_1\n"
+_column_list = [['query', 'q'], ['subject', 'q'], ['identity', 'd'], ['length', 'q'], ['bitscore', 'd']]
+
+
+class blast_hits:
+    # Hits of a blast file with the genes replaced by their ids in gene catalog, in the order of blast file.
+    # The columns are arrays indexed by hit, they are memoryviews of file if the hits are loaded from file
+    __slots__ = ['query', 'subject', 'identity', 'length', 'bitscore', '_mm']
+
+    def __init__(self):
+        for col, type_code in _column_list:
+            setattr(self, col, array(type_code))
+        self._mm = None
+
+    def __len__(self):
+        return len(self.query)
+
+    def close(self):
+        if self._mm is not None:
+            for col, _ in _column_list:
+                getattr(self, col).release()
+            self._mm.close()
+            self._mm = None
+
+
+def read_blast_chunks(blast, chunk_size=1 << 26):
+    # Read blast file with chunks of lines, chunk_size is the approximate bytes of each chunk
+    with open_file(blast, 'r') as fin:
+        while True:
+            lines = fin.readlines(chunk_size)
+            if not lines:
+                break
+            yield lines
+
+
+def read_query_groups(blast):
+    # Yield query name and lines of its hits, the hits of a query are continuous in blast output
+    with open_file(blast, 'r') as fin:
+        qry = None
+        lines = []
+        for line in fin:
+            name = line.split('\t', 1)[0]
+            if name != qry:
+                if lines:
+                    yield qry, lines
+                qry = name
+                lines = []
+            lines.append(line)
+        if lines:
+            yield qry, lines
+
+
+def get_hits_header(blast, catalog):
+    stat = os.stat(blast)
+    return {'blast_size': stat.st_size, 'blast_mtime': stat.st_mtime_ns, 'catalog': catalog.get_key()}
+
+
+def parse_blast_chunks(blast, catalog, record, chunk_hits=0):
+    # Parse blast file with format 6 and yield hits with chunks of at least chunk_hits hits, all hits are in one
+    # chunk if chunk_hits is 0. Hits with genes not in catalog are dropped since they are never used.
+    # The counts of lines and kept hits are added to record
+    gene_id = catalog.id_db
+    hits = blast_hits()
+    record['hits'] = 0
+    record['kept'] = 0
+    for lines in read_blast_chunks(blast):
+        record['hits'] += len(lines)
+        query = hits.query
+        subject = hits.subject
+        identity = hits.identity
+        length = hits.length
+        bitscore = hits.bitscore
+        for line in lines:
+            data = line.split()
+            if len(data) < 12:
+                continue
+            qg = gene_id.get(data[0])
+            if qg is None:
+                continue
+            rg = gene_id.get(data[1])
+            if rg is None:
+                continue
+            query.append(qg)
+            subject.append(rg)
+            identity.append(float(data[2]))
+            length.append(int(data[3]))
+            bitscore.append(float(data[-1]))
+        if chunk_hits > 0 and len(hits) >= chunk_hits:
+            record['kept'] += len(hits)
+            yield hits
+            hits = blast_hits()
+    record['kept'] += len(hits)
+    yield hits
+
+
+def write_hits_header(fout, blast, catalog, hit_cnt):
+    header = get_hits_header(blast, catalog)
+    header['hits'] = hit_cnt
+    header_line = json.dumps(header).encode()
+    # Pad header, so the columns are aligned to 8 bytes
+    header_line += b' ' * (-(len(_magic) + len(header_line) + 1) % 8) + b'\n'
+    fout.write(_magic)
+    fout.write(header_line)
+
+
+def convert_blast(blast, catalog, out_file, chunk_hits=1 << 20):
+    # Parse blast file once and save the hits to out_file. At most chunk_hits hits are kept in memory, they are
+    # appended to the temporary files of columns, and the columns are joined after the header at the end
+    with stage("blast_convert", inputs=[blast], outputs=[out_file]) as record:
+        col_file_list = ["%s.%s.tmp" % (out_file, col) for col, _ in _column_list]
+        fcol_list = [open(col_file, 'wb') for col_file in col_file_list]
+        for hits in parse_blast_chunks(blast, catalog, record, chunk_hits):
+            for (col, _), fcol in zip(_column_list, fcol_list):
+                getattr(hits, col).tofile(fcol)
+        for fcol in fcol_list:
+            fcol.close()
+        # Write to a temporary file first, so that a broken file is never loaded
+        with open(out_file + ".tmp", 'wb') as fout:
+            write_hits_header(fout, blast, catalog, record['kept'])
+            for col_file in col_file_list:
+                with open(col_file, 'rb') as fin:
+                    shutil.copyfileobj(fin, fout, 1 << 24)
+                os.remove(col_file)
+        os.replace(out_file + ".tmp", out_file)
+
+
+def parse_and_cache_blast(blast, catalog, out_file):
+    # Parse all hits of blast file into memory and return them, the cache is written from the parsed columns, so the
+    # first parse only costs a sequential write besides parsing
+    with stage("blast_convert", inputs=[blast], outputs=[out_file]) as record:
+        hits = next(parse_blast_chunks(blast, catalog, record))
+        with open(out_file + ".tmp", 'wb') as fout:
+            write_hits_header(fout, blast, catalog, len(hits))
+            for col, _ in _column_list:
+                getattr(hits, col).tofile(fout)
+        os.replace(out_file + ".tmp", out_file)
+    return hits
+
+
+def check_hits_cache(blast, catalog, cache_file):
+    # Return the opened cache file of blast, count of hits and offset of columns, or None if the cache does not
+    # exist, or the blast file or catalog changed since it was written
+    if not os.path.exists(cache_file):
+        return None
+    fin = open(cache_file, 'rb')
+    if fin.readline() == _magic:
+        header = json.loads(fin.readline())
+        hit_cnt = header.pop('hits')
+        if header == get_hits_header(blast, catalog):
+            return fin, hit_cnt, fin.tell()
+    fin.close()
+    return None
+
+
+def open_hits_cache(blast, catalog, cache_file=""):
+    # Return the opened cache file of blast, count of hits and offset of columns, default cache file is blast file
+    # with suffix ".hits". The cache is converted from blast if it is not valid, see check_hits_cache
+    if cache_file == "":
+        cache_file = blast + ".hits"
+    cache = check_hits_cache(blast, catalog, cache_file)
+    if cache is None:
+        convert_blast(blast, catalog, cache_file)
+        cache = check_hits_cache(blast, catalog, cache_file)
+    if cache is None:
+        print("Fatal error, cannot load hits of %s from %s" % (blast, cache_file))
+        exit(-1)
+    return cache
+
+
+def load_blast_hits(blast, catalog, cache_file=""):
+    # Load all hits of blast, the columns are memory-mapped from cache file if it is valid, otherwise the blast file
+    # is parsed into memory and the cache is written for later runs, see check_hits_cache
+    if cache_file == "":
+        cache_file = blast + ".hits"
+    cache = check_hits_cache(blast, catalog, cache_file)
+    if cache is None:
+        return parse_and_cache_blast(blast, catalog, cache_file)
+    fin, hit_cnt, offset = cache
+    hits = blast_hits()
+    with fin:
+        if hit_cnt == 0:
+            return hits
+        hits._mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    for col, type_code in _column_list:
+        setattr(hits, col, memoryview(hits._mm)[offset: offset + hit_cnt * 8].cast(type_code))
+        offset += hit_cnt * 8
+    return hits
+
+
+def iter_hit_chunks(blast, catalog, chunk_hits, cache_file=""):
+    # Yield hits of blast with chunks of at most chunk_hits hits, only one chunk is kept in memory
+    fin, hit_cnt, offset = open_hits_cache(blast, catalog, cache_file)
+    with fin:
+        for start in range(0, hit_cnt, chunk_hits):
+            cnt = min(chunk_hits, hit_cnt - start)
+            hits = blast_hits()
+            for col_idx in range(len(_column_list)):
+                fin.seek(offset + (col_idx * hit_cnt + start) * 8)
+                getattr(hits, _column_list[col_idx][0]).fromfile(fin, cnt)
+            yield hits
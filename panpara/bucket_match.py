@@ -0,0 +1,132 @@
+import os
+from array import array
+import numpy as np
+
+
+# Each matched hit is saved as position of hit, index of gene to be matched, index of matched gene and score
+_record_types = ['q', 'q', 'q', 'd']
+_record_size = 32
+
+
+def get_best_matches(match_iter):
+    # match_iter yields position, index of gene to be matched, index of matched gene and score of hits passed the
+    # filters with the order of hits.
+    # Return dict of index -> best score, and dict of index -> set of best matched indices, the keys are ordered by
+    # the first hit of each gene
+    match_score = {}
+    match_db = {}
+    for _, si, fi, score in match_iter:
+        best = match_score.get(si)
+        if best is None or score > best:
+            match_score[si] = score
+            match_db[si] = {fi}
+        elif score == best:
+            match_db[si].add(fi)
+    return match_score, match_db
+
+
+def get_best_match_columns(si, fi, score):
+    # The same as get_best_matches with the matches in numpy columns of index of gene to be matched, index of
+    # matched gene and score with the order of hits. The best scores and ties are found with whole columns, and the
+    # sets of best matched indices are filled with the order of hits, so they are the same as get_best_matches
+    match_score = {}
+    match_db = {}
+    if len(si) == 0:
+        return match_score, match_db
+    genes, first, inverse = np.unique(si, return_index=True, return_inverse=True)
+    best = np.full(len(genes), -np.inf)
+    np.maximum.at(best, inverse, score)
+    tie = np.flatnonzero(score == best[inverse])
+    # Ties grouped by gene, stable sort keeps the order of hits in each group
+    tie = tie[np.argsort(inverse[tie], kind='stable')]
+    bounds = np.searchsorted(inverse[tie], np.arange(len(genes) + 1)).tolist()
+    tie_fi = fi[tie].tolist()
+    gene_list = genes.tolist()
+    best_list = best.tolist()
+    for idx in np.argsort(first, kind='stable').tolist():
+        match_score[gene_list[idx]] = best_list[idx]
+        match_db[gene_list[idx]] = set(tie_fi[bounds[idx]: bounds[idx + 1]])
+    return match_score, match_db
+
+
+def _flush_buckets(buffers, bucket_files):
+    # Append buffered records to bucket files as a block of count and columns
+    for buf, bucket_file in zip(buffers, bucket_files):
+        if len(buf[0]) == 0:
+            continue
+        with open(bucket_file, 'ab') as fout:
+            array('q', [len(buf[0])]).tofile(fout)
+            for col in buf:
+                col.tofile(fout)
+                del col[:]
+
+
+def _read_bucket(bucket_file):
+    # Return columns of all records in bucket file
+    cols = [array(type_code) for type_code in _record_types]
+    with open(bucket_file, 'rb') as fin:
+        while True:
+            cnt = array('q')
+            try:
+                cnt.fromfile(fin, 1)
+            except EOFError:
+                break
+            for col in cols:
+                col.fromfile(fin, cnt[0])
+    return cols
+
+
+def get_bucket_count(hit_cnt, max_memory):
+    # Records of one bucket should fit into half of max_memory
+    return max(1, -(-hit_cnt * _record_size // max(1, max_memory // 2)))
+
+
+def get_best_matches_bucketed(match_iter, hit_cnt, bucket_dir, max_memory):
+    # The same as get_best_matches with bounded memory, max_memory is the bytes could be used. The records are
+    # partitioned by gene to be matched into bucket files, so that records of one bucket fit into half of
+    # max_memory, and the other half is used to buffer records before appending them to bucket files.
+    # The best matches of buckets are merged with the order of first hit of each gene
+    bucket_cnt = get_bucket_count(hit_cnt, max_memory)
+    buffer_limit = max(1, max_memory // 2 // _record_size)
+    if not os.path.exists(bucket_dir):
+        os.makedirs(bucket_dir)
+    bucket_files = [os.path.join(bucket_dir, "bucket%d.bin" % idx) for idx in range(bucket_cnt)]
+    for bucket_file in bucket_files:
+        if os.path.exists(bucket_file):
+            os.remove(bucket_file)
+
+    buffers = [[array(type_code) for type_code in _record_types] for _ in range(bucket_cnt)]
+    buffered = 0
+    for record in match_iter:
+        buf = buffers[record[1] % bucket_cnt]
+        for col, value in zip(buf, record):
+            col.append(value)
+        buffered += 1
+        if buffered >= buffer_limit:
+            _flush_buckets(buffers, bucket_files)
+            buffered = 0
+    _flush_buckets(buffers, bucket_files)
+
+    # Records of a bucket are in the order of hits, since they are appended in order
+    result_list = []
+    for bucket_file in bucket_files:
+        if not os.path.exists(bucket_file):
+            continue
+        pos_col, si_col, fi_col, score_col = _read_bucket(bucket_file)
+        first_db = {}
+        for pos, si in zip(pos_col, si_col):
+            if si not in first_db:
+                first_db[si] = pos
+        match_score, match_db = get_best_matches(zip(pos_col, si_col, fi_col, score_col))
+        for si in match_score:
+            result_list.append([first_db[si], si, match_score[si], match_db[si]])
+        os.remove(bucket_file)
+    os.rmdir(bucket_dir)
+
+    result_list.sort(key=lambda x: x[0])
+    match_score = {}
+    match_db = {}
+    for _, si, score, best_set in result_list:
+        match_score[si] = score
+        match_db[si] = best_set
+    return match_score, match_db
@@ -0,0 +1,145 @@
+import gzip
+import io
+import os
+import shutil
+import signal
+import subprocess
+
+
+# Compressed files are recognized by their magic bytes when reading, and compressed with the method of their suffix
+# when writing, so the readers never need to know how a file was written
+_magic_list = [[b'\x1f\x8b', "gzip"], [b'\x28\xb5\x2f\xfd', "zstd"]]
+_suffix_db = {"gzip": ".gz", "zstd": ".zst"}
+
+
+class pipe_file:
+    # File object of the input or output stream of a compression process, close waits for the process
+    def __init__(self, proc, stream, path, reading):
+        self._proc = proc
+        self._stream = stream
+        self._path = path
+        self._reading = reading
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        return iter(self._stream)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+    def fileno(self):
+        # The stream should not be written before its file descriptor is used by other processes
+        return self._stream.fileno()
+
+    def close(self):
+        if self._proc is None:
+            return
+        self._stream.close()
+        if self._proc.stdout is not None:
+            self._proc.stdout.close()
+        returncode = self._proc.wait()
+        self._proc = None
+        # The decompression is killed by SIGPIPE if the file is closed before the end
+        if self._reading and returncode == -signal.SIGPIPE:
+            return
+        if returncode != 0:
+            print("Fatal error, compression of %s failed with exit code %d" % (self._path, returncode))
+            exit(-1)
+
+
+def get_compress_suffix(compress):
+    # compress is "", "gzip" or "zstd"
+    return _suffix_db.get(compress, "")
+
+
+def get_file_compress(in_file):
+    # Return the compression method of in_file by its magic bytes, "" for plain or missing file
+    try:
+        with open(in_file, 'rb') as fin:
+            head = fin.read(4)
+    except OSError:
+        return ""
+    for magic, compress in _magic_list:
+        if head.startswith(magic):
+            return compress
+    return ""
+
+
+def get_suffix_compress(out_file):
+    # Return the compression method of out_file by its suffix
+    for compress in _suffix_db:
+        if out_file.endswith(_suffix_db[compress]):
+            return compress
+    return ""
+
+
+def strip_compress_suffix(in_file):
+    compress = get_suffix_compress(in_file)
+    if compress == "":
+        return in_file
+    return in_file[: -len(_suffix_db[compress])]
+
+
+def find_input_file(in_file):
+    # Return in_file or its compressed version which exists, in_file is returned if none of them exists
+    for suffix in [""] + list(_suffix_db.values()):
+        if os.path.exists(in_file + suffix):
+            return in_file + suffix
+    return in_file
+
+
+def _get_compress_cmd(compress, threads):
+    # pigz is used for gzip if it is installed, zstd is always multi-threaded
+    if compress == "zstd":
+        return ["zstd", "-q", "-T%d" % max(1, int(threads))]
+    if shutil.which("pigz") is not None:
+        return ["pigz", "-p", str(max(1, int(threads)))]
+    return ["gzip"]
+
+
+def _open_pipe(cmd, path, mode, reading):
+    if shutil.which(cmd[0]) is None:
+        print("Fatal error, %s is required by %s" % (cmd[0], path))
+        exit(-1)
+    if reading:
+        proc = subprocess.Popen(cmd + ["-dc", path], stdout=subprocess.PIPE)
+        stream = proc.stdout
+    else:
+        fout = open(path, 'wb')
+        proc = subprocess.Popen(cmd + ["-c"], stdin=subprocess.PIPE, stdout=fout)
+        fout.close()
+        stream = proc.stdin
+    if 'b' not in mode:
+        stream = io.TextIOWrapper(stream)
+    return pipe_file(proc, stream, path, reading)
+
+
+def open_file(path, mode='r', threads=1):
+    # Open plain or compressed file, mode is one of r, rb, w and wb. Compressed files are read and written through
+    # the external programs, so the (de)compression runs in parallel with the caller, threads is the threads of
+    # compression
+    reading = 'r' in mode
+    if reading:
+        compress = get_file_compress(path)
+    else:
+        compress = get_suffix_compress(path)
+    if compress == "":
+        return open(path, mode)
+    if compress == "gzip" and shutil.which("gzip") is None:
+        return gzip.open(path, mode if 'b' in mode else mode + 't')
+    return _open_pipe(_get_compress_cmd(compress, threads), path, mode, reading)
+
+
+def get_plain_file(in_file, out_file):
+    # Return in_file if it is not compressed, otherwise decompress it to out_file and return out_file, the caller
+    # should remove it after use
+    if get_file_compress(in_file) == "":
+        return in_file
+    with open_file(in_file, 'rb') as fin, open(out_file, 'wb') as fout:
+        shutil.copyfileobj(fin, fout, 1 << 24)
+    return out_file
@@ -0,0 +1,159 @@
+import hashlib
+import json
+import math
+import os
+from .blast_hits import read_query_groups
+from .get_cds_with_bed import build_fasta_index, get_index_header
+
+
+# Bit score of an exact match of blastn (megablast, reward 1, penalty -2), bits = (lambda * length - ln(K)) / ln(2)
+_blastn_lambda = 1.28
+_blastn_k = 0.46
+# Hash table of reference sequences kept between plans in this process, the reference of an iteration is the
+# reference of previous iteration with more fasta files, so only the hashes of new files are added
+_ref_hash_state = {'files': [], 'db': {}}
+
+
+def get_seq_hashes(in_fa):
+    # Yield name, header, hash and length of each sequence of in_fa, the sequence is normalized by removing blanks
+    # and converting to upper case before hashing. The name is the first word of header, which is used by blast
+    fa_idx = build_fasta_index(in_fa)
+    with open(in_fa, 'rb') as fin:
+        for id in fa_idx:
+            offset, raw_len = fa_idx[id]
+            fin.seek(offset)
+            seq = b''.join(fin.read(raw_len).split()).upper()
+            yield id.split()[0], id, hashlib.sha1(seq).digest(), len(seq)
+
+
+def load_seq_hashes(in_fa, save=True):
+    # Return list of name and hash of each sequence of in_fa, see get_seq_hashes. The hashes are saved as
+    # in_fa.hash if save is True, the first line is the json of size and modified time of in_fa, and they are
+    # reused until in_fa changed
+    hash_file = in_fa + ".hash"
+    header = get_index_header(in_fa)
+    if os.path.exists(hash_file):
+        with open(hash_file, 'r') as fin:
+            header_line = fin.readline()
+            if header_line[:1] == '#' and json.loads(header_line[1:]) == header:
+                hash_list = []
+                for line in fin:
+                    name, seq_hash = line.rstrip('\n').split('\t')
+                    hash_list.append([name, bytes.fromhex(seq_hash)])
+                return hash_list
+
+    hash_list = [[name, seq_hash] for name, _, seq_hash, _ in get_seq_hashes(in_fa)]
+    if save:
+        # The temporary file is named with pid, since the same fasta could be hashed by processes at the same time
+        tmp_file = "%s.%d.tmp" % (hash_file, os.getpid())
+        try:
+            with open(tmp_file, 'w') as fout:
+                fout.write("#%s\n" % json.dumps(header))
+                for name, seq_hash in hash_list:
+                    fout.write("%s\t%s\n" % (name, seq_hash.hex()))
+            os.replace(tmp_file, hash_file)
+        except OSError:
+            print("Warning, cannot write hashes of %s, hashes would not be reused" % in_fa)
+    return hash_list
+
+
+def get_ref_hashes(ref_list, out_dir):
+    # Return dict of hash -> list of names of reference sequences in ref_list. If ref_list starts with the files of
+    # last call in this process, the table of last call is reused and only the hashes of other files are added.
+    # The plain copies of compressed references in out_dir are removed after blast, so their hashes are not saved
+    key_list = []
+    for ref in ref_list:
+        stat = os.stat(ref)
+        key_list.append([os.path.abspath(ref), stat.st_size, stat.st_mtime_ns])
+    file_list = _ref_hash_state['files']
+    if key_list[:len(file_list)] != file_list:
+        file_list = []
+        _ref_hash_state['files'] = file_list
+        _ref_hash_state['db'] = {}
+    ref_hash_db = _ref_hash_state['db']
+    for idx in range(len(file_list), len(ref_list)):
+        save = os.path.dirname(key_list[idx][0]) != os.path.abspath(out_dir)
+        for name, seq_hash in load_seq_hashes(ref_list[idx], save):
+            if seq_hash not in ref_hash_db:
+                ref_hash_db[seq_hash] = []
+            ref_hash_db[seq_hash].append(name)
+        file_list.append(key_list[idx])
+    return ref_hash_db
+
+
+def get_exact_bitscore(length):
+    return (_blastn_lambda * length - math.log(_blastn_k)) / math.log(2)
+
+
+def plan_exact_blast(qry, ref_list, out_dir):
+    # Find the query sequences could be resolved without blast, and write the rest to out_dir/exact_qry.fa.
+    # Queries identical with reference sequences in ref_list are resolved with synthetic hits, ref_list should be
+    # empty for self comparison. Queries identical with a previous query are skipped and get the hits of that query.
+    # Return dict of plan with
+    #   query: fasta of queries should be searched
+    #   seqs: count of queries should be searched
+    #   names: list of names of all queries with order of qry
+    #   resolved: dict of query name -> [list of identical reference names, length]
+    #   reps: dict of skipped query name -> name of the first identical query
+    ref_hash_db = get_ref_hashes(ref_list, out_dir)
+
+    plan = {'query': os.path.join(out_dir, "exact_qry.fa"), 'seqs': 0, 'names': [], 'resolved': {}, 'reps': {}}
+    fa_idx = build_fasta_index(qry)
+    qry_hash_db = {}
+    with open(qry, 'rb') as fin, open(plan['query'], 'wb') as fout:
+        for name, id, seq_hash, length in get_seq_hashes(qry):
+            plan['names'].append(name)
+            if seq_hash in ref_hash_db:
+                # The names are copied, since the table is extended by later plans
+                plan['resolved'][name] = [list(ref_hash_db[seq_hash]), length]
+            elif seq_hash in qry_hash_db:
+                plan['reps'][name] = qry_hash_db[seq_hash]
+            else:
+                qry_hash_db[seq_hash] = name
+                offset, raw_len = fa_idx[id]
+                fin.seek(offset)
+                fout.write(b">%s\n" % id.encode())
+                fout.write(fin.read(raw_len))
+                plan['seqs'] += 1
+    return plan
+
+
+def iter_exact_hits(plan, blast):
+    # Yield hits of all queries with the order of query, blast is the output of the queries in plan, the hits of
+    # skipped queries are copied from their first identical query with the query name replaced
+    resolved = plan['resolved']
+    reps = plan['reps']
+    dup_cnt = {}
+    for rep in reps.values():
+        dup_cnt[rep] = dup_cnt.get(rep, 0) + 1
+    group_iter = read_query_groups(blast)
+    head = next(group_iter, None)
+    kept = {}
+    for name in plan['names']:
+        if name in resolved:
+            ref_names, length = resolved[name]
+            bit_score = get_exact_bitscore(length)
+            for ref_name in ref_names:
+                yield "%s\t%s\t100.000\t%d\t0\t0\t1\t%d\t1\t%d\t0.0\t%.1f\n" % (name, ref_name, length, length,
+                                                                                length, bit_score)
+        elif name in reps:
+            rep = reps[name]
+            for line in kept[rep]:
+                yield name + line[len(rep):]
+            dup_cnt[rep] -= 1
+            if dup_cnt[rep] == 0:
+                kept.pop(rep)
+        else:
+            lines = []
+            if head is not None and head[0] == name:
+                lines = head[1]
+                head = next(group_iter, None)
+            if name in dup_cnt:
+                kept[name] = lines
+            for line in lines:
+                yield line
+    # Queries not in the plan are kept at the end
+    while head is not None:
+        for line in head[1]:
+            yield line
+        head = next(group_iter, None)
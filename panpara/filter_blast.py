@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+import argparse
+import sys
+from .compress import open_file
+from .gene_catalog import build_gene_catalog
+
+
+def get_opts():
+    groups = argparse.ArgumentParser()
+    groups.add_argument('-1', '--bed1', help="Input first bed", required=True)
+    groups.add_argument('-2', '--bed2', help="Input second bed", required=True)
+    groups.add_argument('-i', '--input', help="Input blast file with format 6, default=\"-\" means stdin", default="-")
+    groups.add_argument('-d', '--iden', help="Identity threshold, default=0.8", default=0.8, type=float)
+    groups.add_argument('-c', '--coverage', help="The threshold of alignment coverage, default=0.8", default=0.8,
+                        type=float)
+    groups.add_argument('-o', '--output', help="Output filtered blast file, it is compressed if it ends with .gz or "
+                                               ".zst", required=True)
+    return groups.parse_args()
+
+
+def filter_blast(fin, fout, bed1, bed2, iden_threshold, cov_threshold, catalog=None):
+    # Drop the hits which can never contribute to paralog table.
+    # For self comparison (bed1 == bed2), hits of gene itself, identity lower than threshold, genes not in bed,
+    # or alignment coverage lower than threshold are dropped.
+    # For comparison between two samples, hits with identity lower than threshold, genes not in any bed,
+    # or gene pairs from same sample are dropped.
+    # catalog is the gene catalog of the run contains genes of bed1 and bed2, it is built from them if it is None.
+    # Return count of kept hits and count of all hits
+    is_self = bed1 == bed2
+    if catalog is None:
+        if is_self:
+            catalog = build_gene_catalog([bed1])
+        else:
+            catalog = build_gene_catalog([bed1, bed2])
+    gene_id = catalog.id_db
+    sample = catalog.sample
+    length = catalog.length
+
+    kept_cnt = 0
+    hit_cnt = 0
+    for line in fin:
+        data = line.split()
+        if len(data) < 12:
+            continue
+        hit_cnt += 1
+        if float(data[2]) < iden_threshold:
+            continue
+        qn = data[0]
+        rn = data[1]
+        if is_self and qn == rn:
+            continue
+        qg = gene_id.get(qn)
+        if qg is None:
+            continue
+        rg = gene_id.get(rn)
+        if rg is None:
+            continue
+        if is_self:
+            if int(data[3]) * 2.0 / (length[qg] + length[rg]) < cov_threshold:
+                continue
+        elif sample[qg] == sample[rg]:
+            continue
+        fout.write(line)
+        kept_cnt += 1
+    return kept_cnt, hit_cnt
+
+
+if __name__ == "__main__":
+    opts = get_opts()
+    bed1 = opts.bed1
+    bed2 = opts.bed2
+    in_blast = opts.input
+    iden_threshold = opts.iden
+    cov_threshold = opts.coverage
+    out_blast = opts.output
+    with open_file(out_blast, 'w') as fout:
+        if in_blast == "-":
+            kept_cnt, hit_cnt = filter_blast(sys.stdin, fout, bed1, bed2, iden_threshold, cov_threshold)
+        else:
+            with open_file(in_blast, 'r') as fin:
+                kept_cnt, hit_cnt = filter_blast(fin, fout, bed1, bed2, iden_threshold, cov_threshold)
+    print("Kept %d of %d hits" % (kept_cnt, hit_cnt))
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import mmap
+import os
+from array import array
+from .compress import open_file
+
+
+# Binary file of catalog:
+#   magic line
+#   header line, json of counts of genes, names of samples and chromosomes, and size of block of gene names
+#   gene names joined with line breaks, padded to multiple of 8 bytes
+#   columns of sample, chromosome, start, end and length, each is an array of 64 bit integers
+_magic = b"PANPARA_GENE_CATALOG_1\n"
+_column_list = ['sample', 'chrom', 'start', 'end', 'length']
+
+
+class gene_catalog:
+    # Genes of all bed files with dense integer ids. The genes of each bed file are numbered with the order of
+    # get_gene_no, so the id of a gene minus the offset of its sample is its index in the sample.
+    # The columns are arrays indexed by gene id, they are memoryviews of file if the catalog is loaded from file
+    __slots__ = ['names', 'id_db', 'sample', 'chrom', 'start', 'end', 'length', 'sample_names', 'sample_offsets',
+                 'chrom_names', '_mm', '_key']
+
+    def __init__(self):
+        self.names = []
+        self.id_db = {}
+        self.sample = array('q')
+        self.chrom = array('q')
+        self.start = array('q')
+        self.end = array('q')
+        self.length = array('q')
+        self.sample_names = []
+        self.sample_offsets = []
+        self.chrom_names = []
+        self._mm = None
+        self._key = ""
+
+    def __len__(self):
+        return len(self.names)
+
+    def get_key(self):
+        # Hash of gene names, the files keyed by gene ids are only valid for catalogs with the same key
+        if self._key == "":
+            self._key = hashlib.sha1('\n'.join(self.names).encode()).hexdigest()
+        return self._key
+
+    def get_local_index(self, id_db):
+        # Convert dict of gene name -> index to the smallest gene id of id_db and an array of gene id minus it ->
+        # index, -1 for genes not in id_db. The array only covers the ids between genes of id_db, so it is as long
+        # as the sample for the genes of a sample instead of the whole catalog
+        gene_id = self.id_db
+        gid_list = [[gene_id[gn], id_db[gn]] for gn in id_db if gn in gene_id]
+        if len(gid_list) == 0:
+            return 0, array('l')
+        offset = min(gid for gid, _ in gid_list)
+        local = array('l', [-1]) * (max(gid for gid, _ in gid_list) - offset + 1)
+        for gid, idx in gid_list:
+            local[gid - offset] = idx
+        return offset, local
+
+    def get_sample_ids(self, smp):
+        # Return range of gene ids of sample
+        idx = self.sample_names.index(smp)
+        if idx + 1 < len(self.sample_offsets):
+            return range(self.sample_offsets[idx], self.sample_offsets[idx + 1])
+        return range(self.sample_offsets[idx], len(self.names))
+
+    def close(self):
+        if self._mm is not None:
+            for col in _column_list:
+                getattr(self, col).release()
+            self._mm.close()
+            self._mm = None
+
+
+def build_gene_catalog(bed_list, smp_list=None):
+    # Build catalog of genes in bed_list, smp_list is the names of samples of bed files, default is the name of
+    # bed file. Genes are sorted with positions in each bed file, duplicated genes are only kept for the first time
+    catalog = gene_catalog()
+    chrom_db = {}
+    for i in range(len(bed_list)):
+        if smp_list is None:
+            smp = os.path.basename(bed_list[i]).split('.')[0]
+        else:
+            smp = smp_list[i]
+        catalog.sample_names.append(smp)
+        catalog.sample_offsets.append(len(catalog.names))
+        bed_genes = []
+        with open_file(bed_list[i], 'r') as fin:
+            for line in fin:
+                data = line.strip().split()
+                bed_genes.append([data[0], int(data[1]), int(data[2]), data[3]])
+        for chrn, sp, ep, gn in sorted(bed_genes):
+            if gn in catalog.id_db:
+                continue
+            if chrn not in chrom_db:
+                chrom_db[chrn] = len(catalog.chrom_names)
+                catalog.chrom_names.append(chrn)
+            catalog.id_db[gn] = len(catalog.names)
+            catalog.names.append(gn)
+            catalog.sample.append(i)
+            catalog.chrom.append(chrom_db[chrn])
+            catalog.start.append(sp)
+            catalog.end.append(ep)
+            catalog.length.append(abs(ep - sp) + 1)
+    return catalog
+
+
+def save_gene_catalog(catalog, out_file):
+    # Write to a temporary file first, so that a broken catalog is never loaded
+    name_block = '\n'.join(catalog.names).encode()
+    name_block += b'\0' * (-len(name_block) % 8)
+    header = {'genes': len(catalog.names), 'samples': catalog.sample_names, 'offsets': catalog.sample_offsets,
+              'chroms': catalog.chrom_names, 'name_size': len(name_block)}
+    header_line = json.dumps(header).encode()
+    # Pad header, so the columns are aligned to 8 bytes
+    header_line += b' ' * (-(len(_magic) + len(header_line) + 1) % 8) + b'\n'
+    with open(out_file + ".tmp", 'wb') as fout:
+        fout.write(_magic)
+        fout.write(header_line)
+        fout.write(name_block)
+        for col in _column_list:
+            array('q', getattr(catalog, col)).tofile(fout)
+    os.replace(out_file + ".tmp", out_file)
+
+
+def load_gene_catalog(in_file):
+    # The columns are memory-mapped, so the catalog is shared by processes without copying, only the dict of gene
+    # name -> gene id is built in memory
+    catalog = gene_catalog()
+    with open(in_file, 'rb') as fin:
+        if fin.readline() != _magic:
+            print("Fatal error, %s is not a gene catalog" % in_file)
+            exit(-1)
+        header = json.loads(fin.readline())
+        name_offset = fin.tell()
+        gene_cnt = header['genes']
+        if gene_cnt == 0:
+            return catalog
+        catalog._mm = mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ)
+    catalog.sample_names = header['samples']
+    catalog.sample_offsets = header['offsets']
+    catalog.chrom_names = header['chroms']
+    name_block = catalog._mm[name_offset: name_offset + header['name_size']].rstrip(b'\0')
+    catalog.names = name_block.decode().split('\n')
+    for gid in range(gene_cnt):
+        catalog.id_db[catalog.names[gid]] = gid
+    offset = name_offset + header['name_size']
+    for col in _column_list:
+        setattr(catalog, col, memoryview(catalog._mm)[offset: offset + gene_cnt * 8].cast('q'))
+        offset += gene_cnt * 8
+    return catalog
@@ -1,15 +1,22 @@
 #!/usr/bin/env python
 import argparse
 import os
+import numpy as np
 from .union_find import union_find
-from .run_mcscanx import run_mcscanx
+from .run_mcscanx import run_mcscanx, run_self_mcscanx, get_gff_line
+from .para_table import load_ref_genes, write_para_table
+from .metrics import stage
+from .gene_catalog import build_gene_catalog
+from .blast_hits import load_blast_hits, open_hits_cache, iter_hit_chunks
+from .bucket_match import get_best_match_columns, get_best_matches_bucketed, get_bucket_count
+from .compress import open_file
 
 
 def get_opt():
     group = argparse.ArgumentParser()
     group.add_argument('-1', '--bed1', help="Input first bed", required=True)
     group.add_argument('-2', '--bed2', help="Input second bed", required=True)
-    group.add_argument('-a', '--table', help="Paralog table, default=\"\"", default="")
+    group.add_argument('-a', '--table', help="Paralog table (para.tbl), default=\"\"", default="")
     group.add_argument('-b', '--blast', help="Input blast file", required=True)
     group.add_argument('-l', '--blast2',
                        help="Self blast of query, if bed1 is different with bed2, this parameter is required, default=\"\"",
@@ -17,13 +24,18 @@ def get_opt():
     group.add_argument('-d', '--iden', help="Identity threshold, default=0.8", default=0.8, type=float)
     group.add_argument('-c', '--coverage', help="The threshold of alignment coverage, default=0.8", default=0.8,
                        type=float)
+    group.add_argument('-m', '--self_col_cache',
+                       help="Cache file of collinearity scores of the sample compared with itself, bed1 for self "
+                            "comparison, otherwise bed2, default=\"\" means no cache", default="")
+    group.add_argument('-M', '--max_memory', help="MB of memory could be used by blast hits, default=0 means no "
+                                                  "limit", default=0, type=int)
     group.add_argument('-o', '--output', help="Output directory", required=True)
     return group.parse_args()
 
 
 def get_gene_no(gene_db, idx_db, len_db, bedfile):
     bed_list = []
-    with open(bedfile, 'r') as fin:
+    with open_file(bedfile, 'r') as fin:
         for line in fin:
             data = line.strip().split()
             bed_list.append([data[0], int(data[1]), int(data[2]), data[3]])
@@ -38,7 +50,245 @@ def get_gene_no(gene_db, idx_db, len_db, bedfile):
         idx += 1
 
 
-def get_best_match_table(bed1, bed2, tbl, blast, blast2, iden_threshold, cov_threshold, outdir):
+def init_ref_state(bed_file, gff_file):
+    # ref_state is a dict with
+    #   id_db: dict of gene name -> index, the index of reference gene is its row number in paralog table
+    #   local: array of gene id in catalog -> index, -1 for genes not in reference, it only covers the gene ids
+    #          up to the last reference gene
+    #   bed_file: bed of reference genes with the order of rows
+    #   gff_file: gff of reference genes for MCScanX with the order of rows
+    # The files are emptied, and only the genes added to reference are appended to them
+    for out_file in [bed_file, gff_file]:
+        open(out_file, 'w').close()
+    return {'id_db': {}, 'local': np.full(0, -1, dtype=np.int64), 'bed_file': bed_file, 'gff_file': gff_file}
+
+
+def add_ref_genes(ref_state, catalog, row_list):
+    # Add rows of [chrn, sp, ep, gn] after the reference genes, so the time only depends on the count of new rows
+    id_db = ref_state['id_db']
+    local = ref_state['local']
+    gene_id = catalog.id_db
+    with open(ref_state['bed_file'], 'a') as fbed, open(ref_state['gff_file'], 'a') as fgff:
+        for chrn, sp, ep, gn in row_list:
+            gid = gene_id[gn]
+            if gid >= len(local):
+                # Double the size, so the array is copied a few times during the run
+                local = np.concatenate([local, np.full(max(gid + 1, len(local) * 2) - len(local), -1,
+                                                       dtype=np.int64)])
+            local[gid] = len(id_db)
+            id_db[gn] = len(id_db)
+            fbed.write("%s\t%d\t%d\t%s\n" % (chrn, sp, ep, gn))
+            fgff.write(get_gff_line(chrn, sp, ep, gn))
+    ref_state['local'] = local
+
+
+def add_ref_bed(ref_state, catalog, ref_bed):
+    # Add the genes in ref_bed after the reference genes, like delta.bed of a comparison finished before
+    row_list = []
+    with open_file(ref_bed, 'r') as fin:
+        for line in fin:
+            data = line.strip().split()
+            row_list.append([data[0], int(data[1]), int(data[2]), data[3]])
+    add_ref_genes(ref_state, catalog, row_list)
+
+
+def load_ref_state(ref_bed_list, catalog, bed_file, gff_file):
+    # Load reference genes with the order of rows in paralog table from the bed files in ref_bed_list, which are the
+    # genes added to reference in each iteration, and write the files of reference again
+    ref_state = init_ref_state(bed_file, gff_file)
+    for ref_bed in ref_bed_list:
+        add_ref_bed(ref_state, catalog, ref_bed)
+    return ref_state
+
+
+def get_id_list(bed_db):
+    # Return dict of gene name -> gene index
+    id_db = {}
+    for gn in bed_db:
+        id_db[gn] = bed_db[gn][0]
+    return id_db
+
+
+def get_local_genes(local, gene_ids):
+    # Return the indices of gene ids with local from get_local_index, -1 for genes out of the range of local
+    offset, local = local
+    if len(local) == 0:
+        return np.full(len(gene_ids), -1, dtype=np.int64)
+    local = np.asarray(local)
+    pos = gene_ids - offset
+    inside = (pos >= 0) & (pos < len(local))
+    return np.where(inside, local[np.where(inside, pos, 0)], -1)
+
+
+def iter_self_matches(hit_chunks, catalog, local, col_list, iden_threshold, cov_threshold, record):
+    # Yield columns of position, subject index, query index and score of the hits passed the filters of each chunk,
+    # see scan_self_blast. The filters and scores are computed with whole columns
+    length = np.asarray(catalog.length)
+    col_list = np.asarray(col_list)
+    pos = 0
+    for hits in hit_chunks:
+        record['hits'] += len(hits)
+        query = np.asarray(hits.query)
+        subject = np.asarray(hits.subject)
+        al = np.asarray(hits.length)
+        fi = get_local_genes(local, query)
+        si = get_local_genes(local, subject)
+        # Skip gene match itself and identity lower than threshold and genes not used
+        mask = (query != subject) & (np.asarray(hits.identity) >= iden_threshold) & (fi >= 0) & (si >= 0)
+        # If the alignment coverage the gene lower than coverage threshold, skip
+        mask &= al * 2.0 / (length[subject] + length[query]) >= cov_threshold
+        idx = np.flatnonzero(mask)
+        fi = fi[idx]
+        si = si[idx]
+        score = np.asarray(hits.bitscore)[idx] / al[idx] * (col_list[fi] * col_list[si])
+        yield idx + pos + 1, si, fi, score
+        pos += len(hits)
+
+
+def iter_cross_matches(hit_chunks, local1, local2, col_list1, col_list2, iden_threshold, record):
+    # Yield columns of position, index2, index1 and score of the hits passed the filters of each chunk, see
+    # scan_cross_blast. The filters and scores are computed with whole columns
+    col_list1 = np.asarray(col_list1)
+    col_list2 = np.asarray(col_list2)
+    pos = 0
+    for hits in hit_chunks:
+        record['hits'] += len(hits)
+        query = np.asarray(hits.query)
+        subject = np.asarray(hits.subject)
+        q1 = get_local_genes(local1, query)
+        q2 = get_local_genes(local2, query)
+        r1 = get_local_genes(local1, subject)
+        r2 = get_local_genes(local2, subject)
+        # Skip gene pairs with lower identity than threshold
+        mask = np.asarray(hits.identity) >= iden_threshold
+        # Skip gene pairs from other samples, indices of genes not in a set are -1
+        mask &= ((q1 >= 0) | (q2 >= 0)) & ((r1 >= 0) | (r2 >= 0))
+        # Skip gene pairs from same sample
+        mask &= ~(((q1 >= 0) & (r1 >= 0)) | ((q2 >= 0) & (r2 >= 0)))
+        idx = np.flatnonzero(mask)
+        forward = q1[idx] >= 0
+        fi = np.where(forward, q1[idx], r1[idx])
+        si = np.where(forward, r2[idx], q2[idx])
+        score = np.asarray(hits.bitscore)[idx] / np.asarray(hits.length)[idx] * (col_list1[fi] * col_list2[si])
+        yield idx + pos + 1, si, fi, score
+        pos += len(hits)
+
+
+def scan_matches(blast, catalog, get_match_iter, max_memory, bucket_dir):
+    # Get best matches of the hits from get_match_iter(hit_chunks, record), which yields columns of matches of each
+    # chunk. If max_memory is more than 0, the hits are read with chunks and the best matches are computed with
+    # buckets in bucket_dir, so that the memory used by hits is at most max_memory bytes, otherwise the hits are
+    # memory-mapped and computed in memory
+    with stage("blast_parse", inputs=[blast]) as record:
+        record['hits'] = 0
+        if max_memory > 0:
+            fin, hit_cnt, _ = open_hits_cache(blast, catalog)
+            fin.close()
+            hit_chunks = iter_hit_chunks(blast, catalog, max(1, max_memory // 4 // 40))
+            match_iter = (match for columns in get_match_iter(hit_chunks, record)
+                          for match in zip(*[col.tolist() for col in columns]))
+            match_score, match_db = get_best_matches_bucketed(match_iter, hit_cnt, bucket_dir, max_memory)
+            record['buckets'] = get_bucket_count(hit_cnt, max_memory)
+        else:
+            hits = load_blast_hits(blast, catalog)
+            _, si, fi, score = next(get_match_iter([hits], record))
+            hits.close()
+            match_score, match_db = get_best_match_columns(si, fi, score)
+        record['matched'] = len(match_db)
+        return match_score, match_db
+
+
+def scan_self_blast(blast, catalog, local, col_list, iden_threshold, cov_threshold, max_memory=0, bucket_dir=""):
+    # Get best matches of each subject gene, local is the gene index of gene ids from get_local_index, only genes
+    # with index not less than 0 are used. The hits are read from the binary cache of blast file.
+    # max_memory and bucket_dir are used for bounded memory, see scan_matches.
+    # Return dict of subject index -> best score, and dict of subject index -> set of best matched query indices
+    return scan_matches(blast, catalog, lambda hit_chunks, record: iter_self_matches(
+        hit_chunks, catalog, local, col_list, iden_threshold, cov_threshold, record), max_memory, bucket_dir)
+
+
+def scan_cross_blast(blast, catalog, local1, local2, col_list1, col_list2, iden_threshold, max_memory=0,
+                     bucket_dir=""):
+    # Get best matches of each gene of second set with genes of first set, hits can be in either direction.
+    # local1 and local2 are the gene indices of the sets from get_local_index, -1 for genes not in the set.
+    # The hits are read from the binary cache of blast file.
+    # max_memory and bucket_dir are used for bounded memory, see scan_matches.
+    # Return dict of index2 -> best score, and dict of index2 -> set of best matched index1
+    return scan_matches(blast, catalog, lambda hit_chunks, record: iter_cross_matches(
+        hit_chunks, local1, local2, col_list1, col_list2, iden_threshold, record), max_memory, bucket_dir)
+
+
+def get_ref_matches(match_score, match_db):
+    # Group queries by the references they best matched.
+    # Return dict of reference index -> list of [query index, score]
+    ref_db = {}
+    for qry in match_db:
+        # For each query, add it to the dict with the reference it best matched
+        for idx in match_db[qry]:
+            if idx not in ref_db:
+                ref_db[idx] = []
+            ref_db[idx].append([qry, match_score[qry]])
+    return ref_db
+
+
+def get_row_queries(ref_db, ref, idx_db2, exists_gn):
+    # Get names of queries best matched with reference ref ordered by score, a query matched with several
+    # references equally is only kept in the first row, exists_gn is the set of queries used by previous rows
+    info = []
+    if ref in ref_db:
+        for qry, _ in sorted(ref_db[ref], key=lambda x: x[1], reverse=True):
+            qry_gn = idx_db2[qry]
+            if qry_gn in exists_gn:
+                continue
+            exists_gn.add(qry_gn)
+            info.append(qry_gn)
+    return info
+
+
+def cluster_paralogs(gene_list, ref_db, len_db):
+    # Use unionfind to connect genes in gene_list with their best matches in ref_db, the longest gene of each
+    # group is used as reference, genes with same length keep the order in gene_list.
+    # Return dict of reference index -> list of other indices in group
+    with stage("union_find") as record:
+        record['genes'] = len(gene_list)
+        local_db = {}
+        for idx in range(len(gene_list)):
+            local_db[gene_list[idx]] = idx
+        uf = union_find(len(gene_list))
+        uf.union_many((local_db[ref], local_db[qry]) for ref in ref_db for qry, _ in ref_db[ref])
+
+        para_db = {}
+        for group in uf.groups():
+            tmp = sorted([gene_list[idx] for idx in group], key=lambda x: len_db[x], reverse=True)
+            para_db[tmp[0]] = tmp[1:]
+        record['groups'] = len(para_db)
+        return para_db
+
+
+def get_self_col_scores(bed, blast, out_dir, cache_file):
+    # Compute collinearity scores of sample compared with itself and save them to cache_file,
+    # so that they could be computed in worker processes before the comparison needs them
+    bed_db = {}
+    idx_db = {}
+    len_db = {}
+    get_gene_no(bed_db, idx_db, len_db, bed)
+    id_db = get_id_list(bed_db)
+    run_self_mcscanx(bed, blast, out_dir, id_db, cache_file)
+    return cache_file
+
+
+def get_best_match_table(bed1, bed2, tbl, blast, blast2, iden_threshold, cov_threshold, outdir, ref_state=None,
+                         self_col_cache="", catalog=None, max_memory=0):
+    # ref_state is the reference genes kept in memory between comparisons, if it is not None, for self comparison,
+    # the empty state from init_ref_state would be filled with the new reference, otherwise it would be used
+    # instead of loading bed1 and tbl, and updated with new reference genes in place. With ref_state, only the rows
+    # matched with queries are visited, the new rows are appended to the files of ref_state, and ref.bed is not
+    # written to outdir.
+    # self_col_cache is the cache file of collinearity scores of the sample compared with itself, that is bed1 for
+    # self comparison, otherwise bed2.
+    # catalog is the gene catalog contains genes of bed1 and bed2, it is built from them if it is None.
+    # max_memory is the MB of memory could be used by blast hits, the best matches are computed with buckets in
+    # outdir if it is more than 0, the result is the same as computed in memory
     if not os.path.exists(outdir):
         os.makedirs(outdir)
 
@@ -52,11 +302,13 @@ def get_best_match_table(bed1, bed2, tbl, blast, blast2, iden_threshold, cov_thr
         print("Fatal error, cannot append infomations to self compare")
         exit(-1)
     # Sorted gene with position, and generate index dict, length dict
-    print("Loading bed1")
-    bed_db1 = {}
-    idx_db1 = {}
-    len_db1 = {}
-    get_gene_no(bed_db1, idx_db1, len_db1, bed1)
+    use_state = ref_state is not None and not is_self
+    if not use_state:
+        print("Loading bed1")
+        bed_db1 = {}
+        idx_db1 = {}
+        len_db1 = {}
+        get_gene_no(bed_db1, idx_db1, len_db1, bed1)
 
     if not is_self:
         print("Loading bed2")
@@ -66,91 +318,47 @@ def get_best_match_table(bed1, bed2, tbl, blast, blast2, iden_threshold, cov_thr
         get_gene_no(bed_db2, idx_db2, len_db2, bed2)
 
     # Get score between two genes, and fill the matrix
-    match_db = {}
-    match_score = {}
-    col_dir = outdir.split('.')
-    col_dir[-1] = "msx"
-    col_out_dir = '.'.join(col_dir)
-    col_score_db = run_mcscanx(bed1, bed2, blast, blast2, col_out_dir)
-
-    print("Scanning blast")
-    with open(blast, 'r') as fin:
-        for line in fin:
-            data = line.strip().split()
-            iden = float(data[2])
-            bs = float(data[-1])
-            al = int(data[3])
-            qn = data[0]
-            rn = data[1]
-            c_score = 1
-            if qn in col_score_db:
-                c_score *= col_score_db[qn]
-            if rn in col_score_db:
-                c_score *= col_score_db[rn]
-
-            score = bs * 1.0 / al * c_score
-
-            if is_self:
-                # Skip gene match itself and identity lower than threshold and genes from other samples
-                if qn == rn or iden < iden_threshold or qn not in bed_db1 or rn not in bed_db1:
-                    continue
-                fi = bed_db1[qn][0]
-                si = bed_db1[rn][0]
-
-                # If the alignment coverage the gene lower than coverage threshold, skip
-                if al * 2.0 / (len_db1[si] + len_db1[fi]) < cov_threshold:
-                    continue
-
-                # Get the highest score and fill in the matrix
-                if si not in match_score or score > match_score[si]:
-                    match_score[si] = score
-                    # Get best matches
-                    match_db[si] = set()
-                    match_db[si].add(fi)
-                elif score == match_score[si]:
-                    match_db[si].add(fi)
-
-            else:
-                # Skip gene pairs with lower identity than threshold
-                if iden < iden_threshold:
-                    continue
-
-                # Skip gene pairs from other samples
-                if (qn not in bed_db1 and qn not in bed_db2) or (rn not in bed_db1 and rn not in bed_db2):
-                    continue
-
-                # Skip gene pairs from same sample
-                if (qn in bed_db1 and rn in bed_db1) or (qn in bed_db2 and rn in bed_db2):
-                    continue
-
-                if qn in bed_db1:
-                    fi = bed_db1[qn][0]
-                    si = bed_db2[rn][0]
-                else:
-                    si = bed_db2[qn][0]
-                    fi = bed_db1[rn][0]
-
-                # Get the highest score and fill in the matrix
-                if si not in match_score or score > match_score[si]:
-                    match_score[si] = score
-                    match_db[si] = set()
-                    match_db[si].add(fi)
-                elif score == match_score[si]:
-                    match_db[si].add(fi)
+    # Collinearity files are written to the directories next to outdir
+    col_dir = os.path.dirname(os.path.abspath(outdir))
+    col_out_dir = os.path.join(col_dir, "msx")
+    bucket_dir = os.path.join(outdir, "buckets")
+    max_memory <<= 20
+    if catalog is None:
+        catalog = build_gene_catalog([bed1] if is_self else [bed1, bed2])
+    # The collinearity scores are lists indexed by gene index
+    if is_self:
+        id_db1 = get_id_list(bed_db1)
+        col_list1 = run_self_mcscanx(bed1, blast, col_out_dir, id_db1, self_col_cache)
+        print("Scanning blast")
+        match_score, match_db = scan_self_blast(blast, catalog, catalog.get_local_index(id_db1), col_list1,
+                                                iden_threshold, cov_threshold, max_memory, bucket_dir)
+    else:
+        if use_state:
+            id_db1 = ref_state['id_db']
+            local1 = (0, ref_state['local'])
+            gff1 = ref_state['gff_file']
+        else:
+            id_db1 = get_id_list(bed_db1)
+            local1 = catalog.get_local_index(id_db1)
+            gff1 = ""
+        id_db2 = get_id_list(bed_db2)
+        col_list1, col_list2 = run_mcscanx(bed1, bed2, blast, blast2, col_out_dir, [id_db1, id_db2], gff1)
+        print("Scanning blast")
+        match_score, match_db = scan_cross_blast(blast, catalog, local1, catalog.get_local_index(id_db2),
+                                                 col_list1, col_list2, iden_threshold, max_memory, bucket_dir)
 
     # First, scan all queries, and get the best references they matched 
     print("Getting best matches")
-    ref_db = {}
-    for qry in match_db:
-        # For each query, add it to the dict with the reference it best matched
-        for idx in match_db[qry]:
-            if idx not in ref_db:
-                ref_db[idx] = []
-            ref_db[idx].append([qry, match_score[qry]])
+    ref_db = get_ref_matches(match_score, match_db)
 
     print("Writing results")
-    outfile = os.path.join(outdir, "para.csv")
+    outfile = os.path.join(outdir, "para.tbl")
+    # Reference genes of new rows, and paralogs of new sample in all rows
+    ref_col_file = os.path.join(outdir, "para_ref.txt")
+    smp_col_file = os.path.join(outdir, "para_col.txt")
     new_ref = os.path.join(outdir, "ref.bed")
+    # The genes added to reference in this comparison
+    delta_ref = os.path.join(outdir, "delta.bed")
     bed2_name = bed2.split('/')[-1].split('.')[0]
 
     # If tbl is null, means here is the first time to construct paralog table
@@ -158,174 +366,94 @@ def get_best_match_table(bed1, bed2, tbl, blast, blast2, iden_threshold, cov_thr
         print("Fatal error, if not self comparison, must afford table constructed by self comparison")
         exit(-1)
     if is_self:
-        with open(outfile, 'w') as fout:
-            with open(new_ref, 'w') as fref:
-                fout.write("#REF,%s\n" % bed2_name)
-
+        with open(ref_col_file, 'w') as fref_col, open(smp_col_file, 'w') as fout:
+            with open(new_ref, 'w') as fref, open(delta_ref, 'w') as fdelta:
                 # For self comparison, use unionfind to connect paralog table
-                ref_cnt = len(bed_db1)
-                uf = union_find(ref_cnt)
-                for ref in ref_db:
-                    for qry, _ in ref_db[ref]:
-                        uf.union(ref, qry)
-
-                # Connect paralogs                
-                para_db = {}
-                for ref in idx_db1:
-                    gid = uf.find(ref)
-                    if gid not in para_db:
-                        para_db[gid] = []
-                    para_db[gid].append([ref, len_db1[ref]])
-
-                para_db_new = {}
-                for gid in para_db:
-                    tmp = []
-                    for ref, _ in sorted(para_db[gid], key=lambda x: x[1], reverse=True):
-                        tmp.append(ref)
-                    ref = tmp[0]
-                    if ref not in para_db_new:
-                        para_db_new[ref] = []
-                    if len(tmp) > 1:
-                        para_db_new[ref] = tmp[1:]
+                para_db_new = cluster_paralogs(range(len(bed_db1)), ref_db, len_db1)
+                new_rows = []
 
                 for ref in sorted(para_db_new):
                     ref_gn = idx_db1[ref]
 
                     # Write new reference bed
-                    fref.write(
-                        "%s\t%d\t%d\t%s\n" % (bed_db1[ref_gn][1], bed_db1[ref_gn][2], bed_db1[ref_gn][3], ref_gn))
+                    ref_line = "%s\t%d\t%d\t%s\n" % (bed_db1[ref_gn][1], bed_db1[ref_gn][2], bed_db1[ref_gn][3], ref_gn)
+                    fref.write(ref_line)
+                    fdelta.write(ref_line)
                     # Add paralogs
                     info = [ref_gn]
                     for qry in para_db_new[ref]:
                         qry_gn = idx_db1[qry]
                         info.append(qry_gn)
-                    fout.write("%s," % ref_gn)
+                    fref_col.write("%s\n" % ref_gn)
                     fout.write("%s\n" % ('|'.join(map(str, info))))
+                    new_rows.append(bed_db1[ref_gn][1:] + [ref_gn])
+        if ref_state is not None:
+            add_ref_genes(ref_state, catalog, new_rows)
+        write_para_table(outfile, "", bed2_name, ref_col_file, smp_col_file)
     else:
         exists_gn = set()
-        with open(outfile, 'w') as fout:
-            with open(new_ref, 'w') as fref:
-                with open(tbl, 'r') as fin:
-                    for line in fin:
-                        # Write header
-                        if line[0] == '#':
-                            col_cnt = len(line.strip().split(','))
-                            fout.write("%s,%s\n" % (line.strip(), bed2_name))
-                        else:
-                            data = line.strip().split(',')
-                            ref_gn = data[0]
-                            ref = bed_db1[ref_gn][0]
-                            # Write new reference bed
-                            fref.write("%s\t%d\t%d\t%s\n" % (
-                            bed_db1[ref_gn][1], bed_db1[ref_gn][2], bed_db1[ref_gn][3], ref_gn))
-                            info = []
-                            if ref in ref_db:
-                                for qry, _ in sorted(ref_db[ref], key=lambda x: x[1], reverse=True):
-                                    qry_gn = idx_db2[qry]
-                                    if qry_gn in exists_gn:
-                                        continue
-                                    exists_gn.add(qry_gn)
-                                    info.append(qry_gn)
-                            data.append('|'.join(info))
-                            fout.write("%s\n" % (','.join(data)))
+        new_rows = []
+        with open(ref_col_file, 'w') as fref_col, open(smp_col_file, 'w') as fout:
+            with open(delta_ref, 'w') as fdelta:
+                fref = None
+                if use_state:
+                    # The rows not matched with queries are empty lines in the column of new sample
+                    row_cnt = 0
+                    for ref in sorted(ref_db):
+                        info = get_row_queries(ref_db, ref, idx_db2, exists_gn)
+                        fout.write("%s%s\n" % ('\n' * (ref - row_cnt), '|'.join(info)))
+                        row_cnt = ref + 1
+                    fout.write('\n' * (len(ref_state['id_db']) - row_cnt))
+                else:
+                    # Only the reference genes of rows are read, the columns of previous samples are unchanged
+                    fref = open(new_ref, 'w')
+                    for ref_gn in load_ref_genes(tbl):
+                        ref, chrn, sp, ep = bed_db1[ref_gn]
+                        # Write new reference bed
+                        fref.write("%s\t%d\t%d\t%s\n" % (chrn, sp, ep, ref_gn))
+                        info = get_row_queries(ref_db, ref, idx_db2, exists_gn)
+                        fout.write("%s\n" % '|'.join(info))
 
                 # The genes not matched with reference should construct paralogs and add to refernce
-                with open(blast2, 'r') as fin:
-                    nomatch_qry = set()
-                    for qry_gn in sorted(bed_db2):
-                        qry = bed_db2[qry_gn][0]
-                        if qry not in match_db and qry_gn not in exists_gn:
-                            nomatch_qry.add(qry_gn)
-
-                    # Get retain queries self comparison
-                    col_dir[-1] = "msx_self"
-                    col_out_dir = '.'.join(col_dir)
-                    col_score_db = run_mcscanx(bed2, bed2, blast2, blast2, col_out_dir)
-                    match_score = {}
-                    match_db = {}
-                    for line in fin:
-                        data = line.strip().split()
-                        iden = float(data[2])
-                        bs = float(data[-1])
-                        al = int(data[3])
-                        qn = data[0]
-                        rn = data[1]
-                        c_score = 1
-                        if qn in col_score_db:
-                            c_score *= col_score_db[qn]
-                        if rn in col_score_db:
-                            c_score *= col_score_db[rn]
-
-                        score = bs * 1.0 / al * c_score
-                        if qn == rn or iden < iden_threshold or qn not in nomatch_qry or rn not in nomatch_qry:
-                            continue
-                        fi = bed_db2[qn][0]
-                        si = bed_db2[rn][0]
-
-                        if al * 2.0 / (len_db2[si] + len_db2[fi]) < cov_threshold:
-                            continue
-                        if si not in match_score or score > match_score[si]:
-                            match_score[si] = score
-                            match_db[si] = set()
-                            match_db[si].add(fi)
-                        elif score == match_score[si]:
-                            match_db[si].add(fi)
-
-                    # Get best matches
-                    qry_db = {}
-                    for qry in match_db:
-                        for idx in match_db[qry]:
-                            if idx not in qry_db:
-                                qry_db[idx] = []
-                            qry_db[idx].append([qry, match_score[qry]])
-
-                    # For self comparison, use unionfind to connect paralog table
-                    qry_cnt = len(nomatch_qry)
-                    nomatch_idx = {}
-                    nomatch_db = {}
-                    idx = 0
-                    for qry_gn in sorted(nomatch_qry):
-                        qry = bed_db2[qry_gn][0]
-                        nomatch_idx[idx] = qry
-                        nomatch_db[qry] = idx
-                        idx += 1
-
-                    uf = union_find(qry_cnt)
-                    for qry in qry_db:
-                        for next_qry, _ in qry_db[qry]:
-                            uf.union(nomatch_db[qry], nomatch_db[next_qry])
-
-                    # Connect paralogs                
-                    para_db = {}
-                    for idx in range(qry_cnt):
-                        gid = uf.find(idx)
-                        if gid not in para_db:
-                            para_db[gid] = []
-                        qry = nomatch_idx[idx]
-                        para_db[gid].append([qry, len_db2[qry]])
-
-                    para_db_new = {}
-                    for gid in para_db:
-                        tmp = []
-                        for qry, _ in sorted(para_db[gid], key=lambda x: x[1], reverse=True):
-                            tmp.append(qry)
-                        qry = tmp[0]
-                        para_db_new[qry] = []
-                        if len(tmp) > 1:
-                            para_db_new[qry] = tmp[1:]
-
-                    for qry in sorted(para_db_new):
-                        qry_gn = idx_db2[qry]
-                        fref.write(
-                            "%s\t%d\t%d\t%s\n" % (bed_db2[qry_gn][1], bed_db2[qry_gn][2], bed_db2[qry_gn][3], qry_gn))
-                        info = ["" for _ in range(col_cnt)]
-                        info[0] = qry_gn
-                        tmp = [qry_gn]
-                        for next_qry in para_db_new[qry]:
-                            next_qry_gn = idx_db2[next_qry]
-                            tmp.append(next_qry_gn)
-                        info.append('|'.join(tmp))
-                        fout.write("%s\n" % (','.join(info)))
+                nomatch_qry = set()
+                for qry_gn in sorted(bed_db2):
+                    qry = bed_db2[qry_gn][0]
+                    if qry not in match_db and qry_gn not in exists_gn:
+                        nomatch_qry.add(qry_gn)
+
+                # Get retain queries self comparison
+                col_out_dir = os.path.join(col_dir, "msx_self")
+                col_list2 = run_self_mcscanx(bed2, blast2, col_out_dir, id_db2, self_col_cache)
+                nomatch_id_db = {}
+                for qry_gn in nomatch_qry:
+                    nomatch_id_db[qry_gn] = id_db2[qry_gn]
+                match_score, match_db = scan_self_blast(blast2, catalog, catalog.get_local_index(nomatch_id_db),
+                                                        col_list2, iden_threshold, cov_threshold, max_memory,
+                                                        bucket_dir)
+
+                # Get best matches, and use unionfind to connect paralog table
+                qry_db = get_ref_matches(match_score, match_db)
+                nomatch_list = [bed_db2[qry_gn][0] for qry_gn in sorted(nomatch_qry)]
+                para_db_new = cluster_paralogs(nomatch_list, qry_db, len_db2)
+
+                for qry in sorted(para_db_new):
+                    qry_gn = idx_db2[qry]
+                    ref_line = "%s\t%d\t%d\t%s\n" % (bed_db2[qry_gn][1], bed_db2[qry_gn][2], bed_db2[qry_gn][3], qry_gn)
+                    if fref is not None:
+                        fref.write(ref_line)
+                    fdelta.write(ref_line)
+                    fref_col.write("%s\n" % qry_gn)
+                    new_rows.append(bed_db2[qry_gn][1:] + [qry_gn])
+                    tmp = [qry_gn]
+                    for next_qry in para_db_new[qry]:
+                        next_qry_gn = idx_db2[next_qry]
+                        tmp.append(next_qry_gn)
+                    fout.write("%s\n" % '|'.join(tmp))
+                if fref is not None:
+                    fref.close()
+        if use_state:
+            add_ref_genes(ref_state, catalog, new_rows)
+        write_para_table(outfile, tbl, bed2_name, ref_col_file, smp_col_file)
     print("Finished")
 
 
@@ -339,4 +467,6 @@ if __name__ == "__main__":
     iden_threshold = opts.iden
     cov_threshold = opts.coverage
     outdir = opts.output
-    get_best_match_table(bed1, bed2, tbl, blast, blast2, iden_threshold, cov_threshold, outdir)
+    self_col_cache = opts.self_col_cache
+    get_best_match_table(bed1, bed2, tbl, blast, blast2, iden_threshold, cov_threshold, outdir,
+                         self_col_cache=self_col_cache, max_memory=opts.max_memory)
@@ -1,45 +1,151 @@
 #!/usr/bin/env python
 import argparse
+import json
 import os
+from .compress import open_file, get_file_compress, strip_compress_suffix, find_input_file
+from .metrics import stage
 
 
 def get_opts():
     groups = argparse.ArgumentParser()
     groups.add_argument('-b', '--bed', help='bed file with 4 columns, \"Chr\tstart_pos\tend_pos\tgene_name\"',
                         required=True)
-    groups.add_argument('-c', '--cds', help='directory of all cds files, all cds files need end with \".cds\"',
+    groups.add_argument('-c', '--cds', help='directory of all cds files, all cds files need end with \".cds\", '
+                                            'could be compressed with \".cds.gz\" or \".cds.zst\"', required=True)
+    groups.add_argument('-s', '--samples', nargs='+', help='samples whose cds contain the genes in bed, only their cds '
+                                                          'files are read, default is all cds files', default=None)
+    groups.add_argument('-o', '--output', help='output cds, it is compressed if it ends with .gz or .zst',
                         required=True)
-    groups.add_argument('-o', '--output', help='output cds', required=True)
     return groups.parse_args()
 
 
-def get_seq_with_list(in_dir, in_list, out_fa):
-    fa_db = {}
-    for in_fa in os.listdir(in_dir):
-        if not in_fa.endswith('.cds'):
-            continue
-        in_fa = os.path.join(in_dir, in_fa)
-        with open(in_fa, 'r') as fin:
-            for line in fin:
-                if line[0] == '>':
-                    id = line.strip()[1:]
-                    fa_db[id] = []
-                else:
-                    fa_db[id].append(line.strip())
+def build_fasta_index(in_fa):
+    # Return dict of sequence name -> [offset, raw_len], offset is the position of the first byte after the header
+    # line, raw_len is the bytes of sequence lines (include line breaks) of the record
+    fa_idx = {}
+    with open(in_fa, 'rb') as fin:
+        id = None
+        offset = 0
+        for line in fin:
+            if line[:1] == b'>':
+                if id is not None:
+                    fa_idx[id][1] = offset - fa_idx[id][0]
+                id = line.strip()[1:].decode()
+                fa_idx[id] = [offset + len(line), 0]
+            offset += len(line)
+        if id is not None:
+            fa_idx[id][1] = offset - fa_idx[id][0]
+    return fa_idx
+
+
+def get_index_header(in_fa):
+    stat = os.stat(in_fa)
+    return {'fa_size': stat.st_size, 'fa_mtime': stat.st_mtime_ns}
+
+
+def load_fasta_index(in_fa):
+    # The index is saved as in_fa.idx and built only once, the first line of index is the json of size and modified
+    # time of the fasta file, it would be rebuilt if the fasta file changed. If the index could not be written,
+    # it is kept in memory only.
+    idx_file = in_fa + ".idx"
+    header = get_index_header(in_fa)
+    if os.path.exists(idx_file):
+        with open(idx_file, 'r') as fin:
+            header_line = fin.readline()
+            if header_line[:1] == '#' and json.loads(header_line[1:]) == header:
+                fa_idx = {}
+                for line in fin:
+                    id, offset, raw_len = line.rstrip('\n').split('\t')
+                    fa_idx[id] = [int(offset), int(raw_len)]
+                return fa_idx
 
-    for id in fa_db:
-        fa_db[id] = ''.join(fa_db[id])
+    fa_idx = build_fasta_index(in_fa)
+    # The temporary file is named with pid, since the same fasta could be indexed by processes at the same time
+    tmp_file = "%s.%d.tmp" % (idx_file, os.getpid())
+    try:
+        with open(tmp_file, 'w') as fout:
+            fout.write("#%s\n" % json.dumps(header))
+            for id in fa_idx:
+                fout.write("%s\t%d\t%d\n" % (id, fa_idx[id][0], fa_idx[id][1]))
+        os.replace(tmp_file, idx_file)
+    except OSError:
+        print("Warning, cannot write index of %s, index would not be reused" % in_fa)
+    return fa_idx
 
-    with open(in_list, 'r') as fin:
-        with open(out_fa, 'w') as fout:
+
+def read_list_seqs(in_fa, id_set):
+    # Yield name and sequence of records of in_fa whose name is in id_set, in_fa is read once from start to end
+    with open_file(in_fa, 'r') as fin:
+        id = None
+        seq_lines = []
+        for line in fin:
+            if line[0] == '>':
+                if id in id_set:
+                    yield id, ''.join(seq_lines)
+                id = line.strip()[1:]
+                seq_lines = []
+            elif id in id_set:
+                seq_lines.append(line.strip())
+        if id in id_set:
+            yield id, ''.join(seq_lines)
+
+
+def get_seq_with_list(in_dir, in_list, out_fa, smp_list=None):
+    # Only the index of fasta files is loaded, and sequences in list are read from files with their offsets.
+    # smp_list is the samples whose cds contain the genes in list, only their cds files are read, default is all cds
+    # files in in_dir.
+    # Compressed fasta files could not be read with offsets, so they are read once and only the sequences in list
+    # are kept in memory. out_fa is compressed if it ends with .gz or .zst
+    with stage("cds_extraction", inputs=[in_list], outputs=[out_fa]) as record:
+        record['genes'] = 0
+        tig_set = set()
+        with open_file(in_list, 'r') as fin:
             for line in fin:
-                if line[0] == '#':
-                    continue
-                else:
-                    tig = line.strip().split()[3]
-                    if tig not in fa_db:
+                if line[0] != '#':
+                    tig_set.add(line.strip().split()[3])
+        if smp_list is None:
+            fa_list = [os.path.join(in_dir, in_fa) for in_fa in os.listdir(in_dir)
+                       if strip_compress_suffix(in_fa).endswith('.cds')]
+        else:
+            fa_list = [find_input_file(os.path.join(in_dir, "%s.cds" % smp)) for smp in smp_list]
+        # Only the genes in list are kept from the indices
+        fa_db = {}
+        seq_db = {}
+        for in_fa in fa_list:
+            if get_file_compress(in_fa) != "":
+                for id, seq in read_list_seqs(in_fa, tig_set):
+                    fa_db[id] = [in_fa, -1, 0]
+                    seq_db[id] = seq
+                continue
+            fa_idx = load_fasta_index(in_fa)
+            for id in fa_idx:
+                if id in tig_set:
+                    fa_db[id] = [in_fa, fa_idx[id][0], fa_idx[id][1]]
+
+        fa_handles = {}
+        with open_file(in_list, 'r') as fin:
+            with open_file(out_fa, 'w') as fout:
+                for line in fin:
+                    if line[0] == '#':
                         continue
-                    fout.write(">%s\n%s\n" % (tig, fa_db[tig]))
+                    else:
+                        tig = line.strip().split()[3]
+                        if tig not in fa_db:
+                            continue
+                        in_fa, offset, raw_len = fa_db[tig]
+                        if offset < 0:
+                            fout.write(">%s\n%s\n" % (tig, seq_db[tig]))
+                            record['genes'] += 1
+                            continue
+                        if in_fa not in fa_handles:
+                            fa_handles[in_fa] = open(in_fa, 'rb')
+                        fa_handles[in_fa].seek(offset)
+                        raw_seq = fa_handles[in_fa].read(raw_len)
+                        seq = b''.join([seq_line.strip() for seq_line in raw_seq.split(b'\n')])
+                        fout.write(">%s\n%s\n" % (tig, seq.decode()))
+                        record['genes'] += 1
+        for in_fa in fa_handles:
+            fa_handles[in_fa].close()
 
 
 if __name__ == "__main__":
@@ -47,4 +153,4 @@ if __name__ == "__main__":
     in_list = opts.bed
     in_dir = opts.cds
     out_fa = opts.output
-    get_seq_with_list(in_dir, in_list, out_fa)
+    get_seq_with_list(in_dir, in_list, out_fa, opts.samples)
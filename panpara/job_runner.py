@@ -0,0 +1,159 @@
+import asyncio
+import os
+import signal
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Statistics of all jobs finished in this process, each one is a dict returned by run_jobs
+job_stats = []
+
+
+def _watch_process(proc, deadline, cancel_event, done_event, stat):
+    # Kill the process group if the job is timeout or cancelled
+    while not done_event.wait(0.2):
+        if cancel_event.is_set():
+            stat['status'] = "cancelled"
+        elif deadline is not None and time.time() > deadline:
+            stat['status'] = "timeout"
+        else:
+            continue
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        break
+
+
+def _run_process(job, cancel_event):
+    # Run one attempt of job, the rusage of the child is got by wait4, so the cpu time and peak rss are only of
+    # this job even if other jobs are running together
+    cmd = job['cmd']
+    work_dir = job.get('work_dir', '.')
+    log_file = job.get('log', os.devnull)
+    stdout = job.get('stdout', None)
+    timeout = job.get('timeout', None)
+    stat = {'name': job.get('name', os.path.basename(cmd[0])), 'cmd': ' '.join(cmd), 'status': "ok"}
+
+    start_time = time.time()
+    with open(log_file, 'a') as flog:
+        flog.write("# Running: %s\n" % stat['cmd'])
+        flog.flush()
+        fout = None
+        if stdout is None:
+            out_pipe = flog
+        elif callable(stdout):
+            out_pipe = subprocess.PIPE
+        elif hasattr(stdout, 'fileno'):
+            # An opened file or pipe, like the input of a compression process
+            out_pipe = stdout
+        else:
+            fout = open(stdout, 'w')
+            out_pipe = fout
+        try:
+            proc = subprocess.Popen(cmd, cwd=work_dir, stdout=out_pipe, stderr=flog, start_new_session=True,
+                                    universal_newlines=True)
+        except OSError as err:
+            # The program is missing or could not be run, it is reported as a failed job like other failures
+            if fout is not None:
+                fout.close()
+            stat.update({'status': "failed", 'returncode': -1, 'wall_time': time.time() - start_time,
+                         'cpu_time': 0.0, 'max_rss': 0})
+            flog.write("# Failed to start: %s\n" % err)
+            flog.write("# Finished: status=%s returncode=%d wall_time=%.2fs cpu_time=%.2fs max_rss=%dKB\n" % (
+                stat['status'], stat['returncode'], stat['wall_time'], stat['cpu_time'], stat['max_rss']))
+            return stat
+        done_event = threading.Event()
+        deadline = None
+        if timeout is not None:
+            deadline = start_time + timeout
+        watcher = threading.Thread(target=_watch_process, args=(proc, deadline, cancel_event, done_event, stat))
+        watcher.start()
+        try:
+            if callable(stdout):
+                # stdout is a function consuming the output stream of the process
+                try:
+                    stdout(proc.stdout)
+                except BaseException:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    os.wait4(proc.pid, 0)
+                    raise
+                proc.stdout.close()
+            _, status, usage = os.wait4(proc.pid, 0)
+        finally:
+            done_event.set()
+            watcher.join()
+            if fout is not None:
+                fout.close()
+        proc.returncode = os.waitstatus_to_exitcode(status)
+
+        stat['returncode'] = proc.returncode
+        if proc.returncode != 0 and stat['status'] == "ok":
+            stat['status'] = "failed"
+        stat['wall_time'] = time.time() - start_time
+        stat['cpu_time'] = usage.ru_utime + usage.ru_stime
+        # ru_maxrss is in KB on linux
+        stat['max_rss'] = usage.ru_maxrss
+        flog.write("# Finished: status=%s returncode=%d wall_time=%.2fs cpu_time=%.2fs max_rss=%dKB\n" % (
+            stat['status'], stat['returncode'], stat['wall_time'], stat['cpu_time'], stat['max_rss']))
+    return stat
+
+
+async def _run_job_async(job, semaphore, executor, cancel_event, fail_fast):
+    loop = asyncio.get_running_loop()
+    async with semaphore:
+        for attempt in range(job.get('retries', 0) + 1):
+            if cancel_event.is_set():
+                return {'name': job.get('name', os.path.basename(job['cmd'][0])), 'cmd': ' '.join(job['cmd']),
+                        'status': "cancelled", 'returncode': -1, 'wall_time': 0.0, 'cpu_time': 0.0, 'max_rss': 0,
+                        'attempts': attempt}
+            stat = await loop.run_in_executor(executor, _run_process, job, cancel_event)
+            stat['attempts'] = attempt + 1
+            if stat['status'] in ("ok", "cancelled"):
+                break
+        if stat['status'] != "ok" and fail_fast:
+            cancel_event.set()
+        return stat
+
+
+async def _run_jobs_async(jobs, max_parallel, fail_fast):
+    semaphore = asyncio.Semaphore(max_parallel)
+    cancel_event = threading.Event()
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        tasks = [_run_job_async(job, semaphore, executor, cancel_event, fail_fast) for job in jobs]
+        try:
+            return await asyncio.gather(*tasks)
+        except asyncio.CancelledError:
+            cancel_event.set()
+            raise
+
+
+def run_jobs(jobs, max_parallel=1, fail_fast=True):
+    # Run external commands with at most max_parallel jobs at the same time, each job is a dict with
+    #   cmd: list of arguments, no shell is used
+    #   work_dir: working directory, default="."
+    #   log: log file, stderr is always appended to it, and stdout too if stdout is not set, default=os.devnull
+    #   stdout: None, a file path, an opened file, or a function which consumes the text output stream of the command
+    #   timeout: seconds before the job is killed, default=None means no limit
+    #   retries: times of rerunning failed or timeout jobs, default=0
+    #   name: name used in statistics, default is the program name
+    # If fail_fast is True, the other jobs are cancelled once a job failed.
+    # Return list of statistics dict of jobs with name, cmd, status (ok, failed, timeout, cancelled), returncode,
+    # wall_time, cpu_time, max_rss and attempts
+    if len(jobs) == 0:
+        return []
+    stats = asyncio.run(_run_jobs_async(jobs, max(1, max_parallel), fail_fast))
+    job_stats.extend(stats)
+    return stats
+
+
+def run_job(cmd, work_dir='.', log='', stdout=None, timeout=None, retries=0, name=''):
+    # Run one job, see run_jobs for the arguments, return its statistics
+    job = {'cmd': cmd, 'work_dir': work_dir, 'stdout': stdout, 'timeout': timeout, 'retries': retries}
+    if log != '':
+        job['log'] = log
+    if name != '':
+        job['name'] = name
+    return run_jobs([job])[0]
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+import argparse
+import os
+from .get_best_match_table import get_gene_no, get_id_list, scan_cross_blast, scan_self_blast, get_ref_matches, \
+    get_row_queries, cluster_paralogs
+from .run_mcscanx import run_mcscanx, run_self_mcscanx
+from .para_table import load_para_table, load_ref_genes, save_para_table
+from .gene_catalog import build_gene_catalog
+
+
+def get_opts():
+    group = argparse.ArgumentParser()
+    group.add_argument('-1', '--bed1', help="Reference genes of first table (ref.bed)", required=True)
+    group.add_argument('-2', '--bed2', help="Reference genes of second table (ref.bed)", required=True)
+    group.add_argument('-x', '--table1', help="First paralog table (para.tbl)", required=True)
+    group.add_argument('-y', '--table2', help="Second paralog table (para.tbl)", required=True)
+    group.add_argument('-b', '--blast', help="Blast between reference genes of two tables", required=True)
+    group.add_argument('-l', '--blast2', help="Self blast of reference genes of second table", required=True)
+    group.add_argument('-d', '--iden', help="Identity threshold, default=0.8", default=0.8, type=float)
+    group.add_argument('-c', '--coverage', help="The threshold of alignment coverage, default=0.8", default=0.8,
+                       type=float)
+    group.add_argument('-M', '--max_memory', help="MB of memory could be used by blast hits, default=0 means no "
+                                                  "limit", default=0, type=int)
+    group.add_argument('-o', '--output', help="Output directory", required=True)
+    return group.parse_args()
+
+
+def load_table_rows(tbl):
+    # Return list of samples, dict of reference gene -> row index, and list of columns, each column is the list
+    # of cells of all rows
+    smp_list, _, col_file_list = load_para_table(tbl)
+    row_db = {}
+    for gn in load_ref_genes(tbl):
+        row_db[gn] = len(row_db)
+    col_list = []
+    for col_file in col_file_list:
+        cells = []
+        with open(col_file, 'r') as fin:
+            for line in fin:
+                cells.append(line.rstrip('\n'))
+        cells.extend([''] * (len(row_db) - len(cells)))
+        col_list.append(cells)
+    return smp_list, row_db, col_list
+
+
+def write_merged_row(fcol_list, col_list, row_db, gn_list):
+    # Write cells of rows of gn_list in each column as one row
+    for fcol, cells in zip(fcol_list, col_list):
+        merged = [cells[row_db[gn]] for gn in gn_list]
+        fcol.write("%s\n" % '|'.join([cell for cell in merged if cell != '']))
+
+
+def merge_para_tables(bed1, bed2, tbl1, tbl2, blast, blast2, iden_threshold, cov_threshold, outdir, catalog=None,
+                      max_memory=0):
+    # Merge paralog table tbl2 into tbl1, bed1 and bed2 are the reference genes of their rows. The reference genes
+    # of tbl2 are matched with the rows of tbl1 in the same way as the genes of a sample in get_best_match_table,
+    # and the cells of matched rows of tbl2 are joined into the row they matched. Unmatched rows are connected with
+    # the self blast of reference genes of tbl2 (blast2), and appended as new rows.
+    # The columns of tbl1 are reused, the columns of tbl2 are rewritten with the rows of merged table.
+    # catalog is the gene catalog contains genes of bed1 and bed2, it is built from them if it is None.
+    # max_memory is the MB of memory could be used by blast hits, see get_best_match_table
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    print("Loading bed1")
+    bed_db1 = {}
+    idx_db1 = {}
+    len_db1 = {}
+    get_gene_no(bed_db1, idx_db1, len_db1, bed1)
+    print("Loading bed2")
+    bed_db2 = {}
+    idx_db2 = {}
+    len_db2 = {}
+    get_gene_no(bed_db2, idx_db2, len_db2, bed2)
+
+    # Collinearity files are written to the directories next to outdir
+    col_dir = os.path.dirname(os.path.abspath(outdir))
+    bucket_dir = os.path.join(outdir, "buckets")
+    max_memory <<= 20
+    if catalog is None:
+        catalog = build_gene_catalog([bed1, bed2])
+    id_db1 = get_id_list(bed_db1)
+    id_db2 = get_id_list(bed_db2)
+    col_list1, col_list2 = run_mcscanx(bed1, bed2, blast, blast2, os.path.join(col_dir, "msx"), [id_db1, id_db2])
+    print("Scanning blast")
+    match_score, match_db = scan_cross_blast(blast, catalog, catalog.get_local_index(id_db1),
+                                             catalog.get_local_index(id_db2), col_list1, col_list2, iden_threshold,
+                                             max_memory, bucket_dir)
+    print("Getting best matches")
+    ref_db = get_ref_matches(match_score, match_db)
+
+    print("Loading table2")
+    smp_list2, row_db2, cell_list2 = load_table_rows(tbl2)
+
+    print("Writing results")
+    outfile = os.path.join(outdir, "para.tbl")
+    ref_col_file = os.path.join(outdir, "para_ref.txt")
+    col_file_list2 = [os.path.join(outdir, "para_col%d.txt" % idx) for idx in range(len(smp_list2))]
+    new_ref = os.path.join(outdir, "ref.bed")
+    delta_ref = os.path.join(outdir, "delta.bed")
+
+    exists_gn = set()
+    fcol_list = [open(col_file, 'w') for col_file in col_file_list2]
+    with open(ref_col_file, 'w') as fref_col, open(new_ref, 'w') as fref, open(delta_ref, 'w') as fdelta:
+        for ref_gn in load_ref_genes(tbl1):
+            ref = bed_db1[ref_gn][0]
+            fref.write("%s\t%d\t%d\t%s\n" % (bed_db1[ref_gn][1], bed_db1[ref_gn][2], bed_db1[ref_gn][3], ref_gn))
+            info = get_row_queries(ref_db, ref, idx_db2, exists_gn)
+            write_merged_row(fcol_list, cell_list2, row_db2, info)
+
+        # The rows not matched with tbl1 should construct paralogs and add to refernce
+        nomatch_qry = set()
+        for qry_gn in sorted(bed_db2):
+            qry = bed_db2[qry_gn][0]
+            if qry not in match_db and qry_gn not in exists_gn:
+                nomatch_qry.add(qry_gn)
+
+        col_list2 = run_self_mcscanx(bed2, blast2, os.path.join(col_dir, "msx_self"), id_db2)
+        nomatch_id_db = {}
+        for qry_gn in nomatch_qry:
+            nomatch_id_db[qry_gn] = id_db2[qry_gn]
+        match_score, match_db = scan_self_blast(blast2, catalog, catalog.get_local_index(nomatch_id_db), col_list2,
+                                                iden_threshold, cov_threshold, max_memory, bucket_dir)
+        qry_db = get_ref_matches(match_score, match_db)
+        nomatch_list = [bed_db2[qry_gn][0] for qry_gn in sorted(nomatch_qry)]
+        para_db_new = cluster_paralogs(nomatch_list, qry_db, len_db2)
+
+        for qry in sorted(para_db_new):
+            qry_gn = idx_db2[qry]
+            ref_line = "%s\t%d\t%d\t%s\n" % (bed_db2[qry_gn][1], bed_db2[qry_gn][2], bed_db2[qry_gn][3], qry_gn)
+            fref.write(ref_line)
+            fdelta.write(ref_line)
+            fref_col.write("%s\n" % qry_gn)
+            write_merged_row(fcol_list, cell_list2, row_db2, [qry_gn] + [idx_db2[idx] for idx in para_db_new[qry]])
+    for fcol in fcol_list:
+        fcol.close()
+
+    smp_list1, ref_file_list1, col_file_list1 = load_para_table(tbl1)
+    save_para_table(outfile, smp_list1 + smp_list2, ref_file_list1 + [ref_col_file], col_file_list1 + col_file_list2)
+    print("Finished")
+
+
+if __name__ == "__main__":
+    opts = get_opts()
+    merge_para_tables(opts.bed1, opts.bed2, opts.table1, opts.table2, opts.blast, opts.blast2, opts.iden,
+                      opts.coverage, opts.output, max_memory=opts.max_memory)
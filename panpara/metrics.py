@@ -0,0 +1,201 @@
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+from . import job_runner
+
+
+# Records of stages are appended to a json lines file as soon as they finished, so the stages run in worker
+# processes and the stages of a killed run are kept. The file and context are inherited by forked workers.
+_metrics_file = ""
+_profile_mode = ""
+_profile_dir = ""
+_profiling = False
+_context = {}
+# Peak rss of the open stages of this process, the stages are nested, so the peak of an inner stage is also the peak
+# of the outer ones
+_peak_list = []
+_peak_pid = 0
+
+
+def init_metrics(metrics_file, profile_mode="", profile_dir=""):
+    # Start recording stages to metrics_file, previous records are removed.
+    # profile_mode is "", "cprofile" or "pyinstrument", the python stages would be profiled and saved to profile_dir
+    global _metrics_file, _profile_mode, _profile_dir
+    _metrics_file = os.path.abspath(metrics_file)
+    if os.path.exists(_metrics_file):
+        os.remove(_metrics_file)
+    _profile_mode = profile_mode
+    _profile_dir = profile_dir
+    if profile_mode == "pyinstrument":
+        try:
+            import pyinstrument
+        except ImportError:
+            print("Warning, pyinstrument is not installed, use cProfile instead")
+            _profile_mode = "cprofile"
+    if _profile_mode != "" and not os.path.exists(_profile_dir):
+        os.makedirs(_profile_dir)
+
+
+def set_metrics_context(**info):
+    # Set fields recorded with all following stages, like iteration and sample, None removes the field
+    for key in info:
+        if info[key] is None:
+            _context.pop(key, None)
+        else:
+            _context[key] = info[key]
+
+
+def call_with_context(info, func, *args):
+    # Call func with metrics context info, used for the jobs submitted to worker processes
+    set_metrics_context(**info)
+    return func(*args)
+
+
+def get_files_size(file_list):
+    size = 0
+    for in_file in file_list:
+        if in_file and os.path.isfile(in_file):
+            size += os.path.getsize(in_file)
+    return size
+
+
+def _read_peak_rss():
+    # Peak rss of this process in KB since it was reset, VmHWM on linux, otherwise the peak of the process lifetime
+    try:
+        with open("/proc/self/status", 'r') as fin:
+            for line in fin:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM to the current rss on linux
+    try:
+        with open("/proc/self/clear_refs", 'w') as fout:
+            fout.write("5")
+    except OSError:
+        pass
+
+
+def _fold_peak_rss():
+    # Add the peak since last reset to all open stages
+    peak = _read_peak_rss()
+    for peak_item in _peak_list:
+        peak_item[0] = max(peak_item[0], peak)
+
+
+def _start_profiler(stage_name):
+    global _profiling
+    if _profile_mode == "" or _profiling:
+        return None
+    _profiling = True
+    if _profile_mode == "pyinstrument":
+        import pyinstrument
+        profiler = pyinstrument.Profiler()
+        profiler.start()
+    else:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    return profiler
+
+
+def _stop_profiler(profiler, record):
+    global _profiling
+    _profiling = False
+    name = "%s_%s_%d_%d" % (record.get('iteration', 0), record['stage'], os.getpid(), int(record['start'] * 1000))
+    if _profile_mode == "pyinstrument":
+        profiler.stop()
+        with open(os.path.join(_profile_dir, name + ".txt"), 'w') as fout:
+            fout.write(profiler.output_text())
+    else:
+        profiler.disable()
+        profiler.dump_stats(os.path.join(_profile_dir, name + ".prof"))
+
+
+@contextmanager
+def stage(stage_name, inputs=(), outputs=(), profile=False):
+    # Record wall time, cpu time, peak rss, size of inputs and outputs of the stage. The cpu time includes the
+    # external jobs run by job_runner in this stage. max_rss is the peak rss of this process during the stage, and
+    # job_max_rss is the largest peak rss of the external jobs run in this stage.
+    # The record dict is yielded, so the caller could add counts like hits to it.
+    global _peak_pid
+    if _peak_pid != os.getpid():
+        # The open stages of the parent are not recorded by a forked worker
+        _peak_list.clear()
+        _peak_pid = os.getpid()
+    _fold_peak_rss()
+    _reset_peak_rss()
+    peak_item = [_read_peak_rss()]
+    _peak_list.append(peak_item)
+    record = dict(_context)
+    record['stage'] = stage_name
+    record['start'] = time.time()
+    record['input_size'] = get_files_size(inputs)
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_time = usage.ru_utime + usage.ru_stime
+    job_cnt = len(job_runner.job_stats)
+    profiler = None
+    if profile:
+        profiler = _start_profiler(stage_name)
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            _stop_profiler(profiler, record)
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        record['wall_time'] = round(time.time() - record['start'], 3)
+        job_list = job_runner.job_stats[job_cnt:]
+        record['cpu_time'] = round(usage.ru_utime + usage.ru_stime - cpu_time +
+                                   sum(job['cpu_time'] for job in job_list), 3)
+        _fold_peak_rss()
+        _peak_list.pop()
+        record['max_rss'] = peak_item[0]
+        record['job_max_rss'] = max([0] + [job['max_rss'] for job in job_list])
+        record['output_size'] = get_files_size(outputs)
+        if _metrics_file != "":
+            with open(_metrics_file, 'a') as fout:
+                fout.write("%s\n" % json.dumps(record))
+
+
+def load_metrics(metrics_file):
+    record_list = []
+    if os.path.exists(metrics_file):
+        with open(metrics_file, 'r') as fin:
+            for line in fin:
+                record_list.append(json.loads(line))
+    record_list.sort(key=lambda x: x['start'])
+    return record_list
+
+
+def write_metrics_report(metrics_file, out_json, out_tsv):
+    # Write records of all stages and the summary of each stage to out_json, and records to out_tsv
+    record_list = load_metrics(metrics_file)
+    summary_db = {}
+    for record in record_list:
+        if record['stage'] not in summary_db:
+            summary_db[record['stage']] = {'count': 0, 'wall_time': 0.0, 'cpu_time': 0.0, 'max_rss': 0,
+                                           'job_max_rss': 0}
+        summary = summary_db[record['stage']]
+        summary['count'] += 1
+        summary['wall_time'] = round(summary['wall_time'] + record['wall_time'], 3)
+        summary['cpu_time'] = round(summary['cpu_time'] + record['cpu_time'], 3)
+        summary['max_rss'] = max(summary['max_rss'], record['max_rss'])
+        summary['job_max_rss'] = max(summary['job_max_rss'], record.get('job_max_rss', 0))
+    with open(out_json, 'w') as fout:
+        json.dump({'stages': record_list, 'summary': summary_db}, fout, indent=1)
+
+    fixed_list = ['iteration', 'sample', 'stage', 'start', 'wall_time', 'cpu_time', 'max_rss', 'job_max_rss',
+                  'input_size', 'output_size', 'hits']
+    with open(out_tsv, 'w') as fout:
+        fout.write("#%s\tinfo\n" % '\t'.join(fixed_list))
+        for record in record_list:
+            data = [str(record.get(key, '')) for key in fixed_list]
+            data.append(';'.join("%s=%s" % (key, record[key]) for key in sorted(record) if key not in fixed_list))
+            fout.write("%s\n" % '\t'.join(data))
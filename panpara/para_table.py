@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+import argparse
+import os
+from .metrics import stage
+
+
+# A paralog table is saved by columns, the table file only records the files of columns:
+#   #REF,sample1,sample2       header of the table
+#   ref\tfile                  reference genes of rows, the rows are the concatenation of all ref files
+#   col\tsample\tfile          paralogs of sample in each row, rows after the end of file are empty
+# The paths are relative to the directory of table file, so that adding a sample only writes the new rows of
+# reference genes and the column of new sample, and the columns of previous samples are reused.
+def get_opts():
+    groups = argparse.ArgumentParser()
+    groups.add_argument('-i', '--input', help='input paralog table, like para.tbl', required=True)
+    groups.add_argument('-o', '--output', help='output csv file', required=True)
+    return groups.parse_args()
+
+
+def load_para_table(tbl):
+    # Return list of samples, list of files of reference genes, list of files of sample columns
+    tbl_dir = os.path.dirname(os.path.abspath(tbl))
+    smp_list = []
+    ref_file_list = []
+    col_file_list = []
+    with open(tbl, 'r') as fin:
+        for line in fin:
+            if line[0] == '#':
+                continue
+            data = line.rstrip('\n').split('\t')
+            if data[0] == 'ref':
+                ref_file_list.append(os.path.abspath(os.path.join(tbl_dir, data[1])))
+            elif data[0] == 'col':
+                smp_list.append(data[1])
+                col_file_list.append(os.path.abspath(os.path.join(tbl_dir, data[2])))
+    return smp_list, ref_file_list, col_file_list
+
+
+def load_ref_genes(tbl):
+    # Yield reference genes of rows in order
+    _, ref_file_list, _ = load_para_table(tbl)
+    for ref_file in ref_file_list:
+        with open(ref_file, 'r') as fin:
+            for line in fin:
+                yield line.rstrip('\n')
+
+
+def write_para_table(tbl, prev_tbl, smp, ref_file, col_file):
+    # Write a table with the columns of prev_tbl, the new rows in ref_file and the new column of smp in col_file,
+    # prev_tbl could be "" if it is the first column
+    smp_list = []
+    ref_file_list = []
+    col_file_list = []
+    if prev_tbl != "":
+        smp_list, ref_file_list, col_file_list = load_para_table(prev_tbl)
+    smp_list.append(smp)
+    ref_file_list.append(ref_file)
+    col_file_list.append(col_file)
+    save_para_table(tbl, smp_list, ref_file_list, col_file_list)
+
+
+def save_para_table(tbl, smp_list, ref_file_list, col_file_list):
+    # Write a table with the files of all rows and columns
+    tbl_dir = os.path.dirname(os.path.abspath(tbl))
+    ref_file_list = [os.path.abspath(ref_file) for ref_file in ref_file_list]
+    col_file_list = [os.path.abspath(col_file) for col_file in col_file_list]
+    with open(tbl, 'w') as fout:
+        fout.write("#REF,%s\n" % ','.join(smp_list))
+        for ref_file in ref_file_list:
+            fout.write("ref\t%s\n" % os.path.relpath(ref_file, tbl_dir))
+        for smp, col_file in zip(smp_list, col_file_list):
+            fout.write("col\t%s\t%s\n" % (smp, os.path.relpath(col_file, tbl_dir)))
+
+
+def export_para_table(tbl, out_csv):
+    # Write paralog table as csv, only one row of each column is kept in memory
+    smp_list, ref_file_list, col_file_list = load_para_table(tbl)
+    with stage("table_write", inputs=ref_file_list + col_file_list, outputs=[out_csv]) as record:
+        record['rows'] = 0
+        col_handles = [open(col_file, 'r') for col_file in col_file_list]
+        with open(out_csv, 'w') as fout:
+            fout.write("#REF,%s\n" % ','.join(smp_list))
+            for ref_file in ref_file_list:
+                with open(ref_file, 'r') as fin:
+                    for line in fin:
+                        data = [line.rstrip('\n')]
+                        for fcol in col_handles:
+                            # readline returns empty string at the end of column
+                            data.append(fcol.readline().rstrip('\n'))
+                        fout.write("%s\n" % ','.join(data))
+                        record['rows'] += 1
+        for fcol in col_handles:
+            fcol.close()
+
+
+def get_table_stats(para_csv):
+    # Count families of exported paralog table, return dict of the counts of families, genes, families with more
+    # than one gene, families with genes of all samples, and the size of largest family
+    stats = {'families': 0, 'genes': 0, 'multi_gene': 0, 'core': 0, 'max_size': 0}
+    smp_cnt = 0
+    with open(para_csv, 'r') as fin:
+        for line in fin:
+            data = line.rstrip('\n').split(',')
+            if line[0] == '#':
+                smp_cnt = len(data) - 1
+                continue
+            cells = [cell for cell in data[1:] if cell != '']
+            size = sum(len(cell.split('|')) for cell in cells)
+            stats['families'] += 1
+            stats['genes'] += size
+            if size > 1:
+                stats['multi_gene'] += 1
+            if len(cells) == smp_cnt:
+                stats['core'] += 1
+            stats['max_size'] = max(stats['max_size'], size)
+    return stats
+
+
+if __name__ == "__main__":
+    opts = get_opts()
+    tbl = opts.input
+    out_csv = opts.output
+    export_para_table(tbl, out_csv)
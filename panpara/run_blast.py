@@ -1,6 +1,15 @@
 #!/usr/bin/env python
 import os
 import argparse
+import heapq
+from .blast_hits import read_query_groups
+from .compress import open_file, get_plain_file, get_suffix_compress
+from .exact_hits import plan_exact_blast, iter_exact_hits
+from .filter_blast import filter_blast
+from .gene_catalog import load_gene_catalog
+from .get_cds_with_bed import build_fasta_index
+from .job_runner import run_job, run_jobs
+from .metrics import stage, call_with_context
 
 
 def get_opts():
@@ -11,37 +20,317 @@ def get_opts():
     groups.add_argument('-e', '--evalue', help='evalue, default=1e-3', default="1e-3")
     groups.add_argument('-f', '--format', help='output format of blast, default=6', default="6")
     groups.add_argument('-n', '--num_alignment', help='number of alignment, if is empty, means all', default="")
-    groups.add_argument('-o', '--output', help='output blast file', required=True)
+    groups.add_argument('-o', '--output', help='output blast file, it is compressed if it ends with .gz or .zst',
+                        required=True)
     groups.add_argument('-t', '--thread', help='threads for blast, default=6', default="6")
+    groups.add_argument('--filter_bed', nargs=2, metavar=('BED1', 'BED2'),
+                        help='filter blast output with two bed files, only work with format 6, if bed1 is same '
+                             'as bed2, means self comparison, default is not filter', default=None)
+    groups.add_argument('--iden', help="identity threshold for filtering, default=0.8", default=0.8, type=float)
+    groups.add_argument('--coverage', help="the threshold of alignment coverage for filtering, default=0.8",
+                        default=0.8, type=float)
+    groups.add_argument('--exact_hash', help="resolve queries identical with reference or previous queries by "
+                                             "hashes of sequences instead of blast", action='store_true')
+    groups.add_argument('-s', '--shards', help="split query into shards and run blast of them at the same time, "
+                                               "default=1", default=1, type=int)
     return groups.parse_args()
 
 
-def run_blast(qry, ref, prog, evalue, fmt, num_aln, out_blast, threads):
-    # Make blast db
+def get_db_type(prog):
     if prog == "blastn":
-        db_type = "nucl"
+        return "nucl"
+    return "prot"
+
+
+def _check_job(stat, prog, log_file):
+    if stat['status'] != "ok":
+        print("Fatal error, %s %s with exit code %d, see %s" % (prog, stat['status'], stat['returncode'], log_file))
+        exit(-1)
+
+
+def make_blast_db(ref, prog, out_db, log_file=""):
+    # ref could be a fasta file or a list of fasta files, log_file is makeblastdb.log in the directory of out_db
+    # by default
+    ref_list = ref if isinstance(ref, list) else [ref]
+    if log_file == "":
+        log_file = os.path.join(os.path.dirname(os.path.abspath(out_db)), "makeblastdb.log")
+    idx_cmd = ["makeblastdb", "-in", ' '.join(ref_list), "-dbtype", get_db_type(prog), "-out", out_db]
+    print("Running makeblastdb: %s" % ' '.join(idx_cmd))
+    with stage("makeblastdb", inputs=ref_list):
+        stat = run_job(idx_cmd, log=log_file)
+    _check_job(stat, "makeblastdb", log_file)
+
+
+def make_alias_db(db_list, prog, out_db, log_file=""):
+    # Make a blast db which is an alias of db_list, so that the databases in db_list could be searched together
+    # without rebuilding them
+    if log_file == "":
+        log_file = os.path.join(os.path.dirname(os.path.abspath(out_db)), "blastdb_aliastool.log")
+    alias_cmd = ["blastdb_aliastool", "-dblist", ' '.join(db_list), "-dbtype", get_db_type(prog), "-out", out_db,
+                 "-title", os.path.basename(out_db)]
+    print("Running blastdb_aliastool: %s" % ' '.join(alias_cmd))
+    with stage("blastdb_aliastool"):
+        stat = run_job(alias_cmd, log=log_file)
+    _check_job(stat, "blastdb_aliastool", log_file)
+
+
+def split_fasta(in_fa, shard_cnt, out_dir):
+    # Split sequences of in_fa into at most shard_cnt files with balanced total length, the longest sequences are
+    # assigned first to the shard with the least length, and sequences keep their order of in_fa in each shard.
+    # Return list of shard files, and list of sequence names with the order of in_fa
+    fa_idx = build_fasta_index(in_fa)
+    name_list = list(fa_idx)
+    shard_cnt = max(1, min(shard_cnt, len(name_list)))
+    heap = [[0, idx] for idx in range(shard_cnt)]
+    shard_seqs = [[] for _ in range(shard_cnt)]
+    for seq_idx in sorted(range(len(name_list)), key=lambda x: fa_idx[name_list[x]][1], reverse=True):
+        total, shard = heapq.heappop(heap)
+        shard_seqs[shard].append(seq_idx)
+        heapq.heappush(heap, [total + fa_idx[name_list[seq_idx]][1], shard])
+
+    shard_list = []
+    with open(in_fa, 'rb') as fin:
+        for shard in range(shard_cnt):
+            shard_file = os.path.join(out_dir, "qry%d.fa" % shard)
+            with open(shard_file, 'wb') as fout:
+                for seq_idx in sorted(shard_seqs[shard]):
+                    offset, raw_len = fa_idx[name_list[seq_idx]]
+                    fin.seek(offset)
+                    fout.write(b">%s\n" % name_list[seq_idx].encode())
+                    fout.write(fin.read(raw_len))
+            shard_list.append(shard_file)
+    # Blast only uses the first word of header as the name of query
+    return shard_list, [name.split()[0] for name in name_list]
+
+
+def merge_shard_blast(name_list, shard_blast_list, out_blast, threads=1):
+    # Write hits of shards to out_blast with the order of queries in name_list, so the result is the same as
+    # the blast of whole query, threads is used for compression of out_blast
+    group_iters = [read_query_groups(shard_blast) for shard_blast in shard_blast_list]
+    heads = [next(group_iter, None) for group_iter in group_iters]
+    head_db = {}
+    for shard in range(len(heads)):
+        if heads[shard] is not None:
+            head_db[heads[shard][0]] = shard
+    with open_file(out_blast, 'w', threads) as fout:
+        for name in name_list:
+            shard = head_db.pop(name, None)
+            if shard is None:
+                continue
+            fout.writelines(heads[shard][1])
+            heads[shard] = next(group_iters[shard], None)
+            if heads[shard] is not None:
+                head_db[heads[shard][0]] = shard
+        # Queries not in name_list are kept at the end with the order of shards
+        for shard in range(len(heads)):
+            while heads[shard] is not None:
+                fout.writelines(heads[shard][1])
+                heads[shard] = next(group_iters[shard], None)
+
+
+def run_shard_blast(blast_cmd, qry, shards, out_blast, threads, blast_filter, work_dir, record, catalog=None):
+    # Run blast of query shards at the same time against the same db, the threads are split among the shards.
+    # If blast_filter is set, the output of each shard is filtered through its own pipe with the same catalog
+    shard_dir = os.path.join(work_dir, "shards")
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+    shard_list, name_list = split_fasta(qry, shards, shard_dir)
+    shard_threads = str(max(1, int(threads) // len(shard_list)))
+    jobs = []
+    cnt_list = []
+    fout_list = []
+    shard_blast_list = []
+    for shard in range(len(shard_list)):
+        shard_blast = os.path.join(shard_dir, "qry%d.blast" % shard)
+        shard_blast_list.append(shard_blast)
+        shard_cmd = blast_cmd[:]
+        shard_cmd[shard_cmd.index("-query") + 1] = shard_list[shard]
+        shard_cmd.extend(["-num_threads", shard_threads])
+        job = {'cmd': shard_cmd, 'log': os.path.join(shard_dir, "blast%d.log" % shard), 'name': "blast_shard"}
+        if blast_filter is None:
+            shard_cmd.extend(["-out", shard_blast])
+        else:
+            bed1, bed2, iden_threshold, cov_threshold = blast_filter
+            fout = open(shard_blast, 'w')
+            fout_list.append(fout)
+            job['stdout'] = lambda fin, fout=fout: cnt_list.append(
+                filter_blast(fin, fout, bed1, bed2, iden_threshold, cov_threshold, catalog))
+        jobs.append(job)
+    print("Running blast with %d shards, %s threads each" % (len(jobs), shard_threads))
+    stats = run_jobs(jobs, max_parallel=len(jobs))
+    for fout in fout_list:
+        fout.close()
+    record['shards'] = len(jobs)
+    if len(cnt_list) != 0:
+        record['kept'] = sum(cnt[0] for cnt in cnt_list)
+        record['hits'] = sum(cnt[1] for cnt in cnt_list)
+    for shard in range(len(jobs)):
+        _check_job(stats[shard], blast_cmd[0], jobs[shard]['log'])
+
+    merge_shard_blast(name_list, shard_blast_list, out_blast, threads)
+    for shard in range(len(jobs)):
+        os.remove(shard_list[shard])
+        os.remove(shard_blast_list[shard])
+    return cnt_list
+
+
+def _search_blast(blast_cmd, qry, out_blast, threads, blast_filter, work_dir, shards, stage_name, catalog=None):
+    # Run blast_cmd without threads and output, see run_blast for the arguments
+    prog = blast_cmd[0]
+    log_file = os.path.join(work_dir, "blast.log")
+    if shards > 1:
+        with stage(stage_name, inputs=[qry], outputs=[out_blast]) as record:
+            cnt_list = run_shard_blast(blast_cmd, qry, shards, out_blast, threads, blast_filter, work_dir, record,
+                                       catalog)
+        if len(cnt_list) != 0:
+            print("Kept %d of %d hits" % (record['kept'], record['hits']))
+        return
+
+    blast_cmd = blast_cmd + ["-num_threads", str(threads)]
+    if blast_filter is None and get_suffix_compress(out_blast) != "":
+        # The output is compressed while blast is writing it to the pipe of compression
+        print("Running blast with compression: %s" % ' '.join(blast_cmd))
+        with stage(stage_name, inputs=[qry], outputs=[out_blast]):
+            with open_file(out_blast, 'wb', threads) as fout:
+                stat = run_job(blast_cmd, log=log_file, stdout=fout)
+        _check_job(stat, prog, log_file)
+    elif blast_filter is None:
+        blast_cmd.extend(["-out", out_blast])
+        print("Running blast: %s" % ' '.join(blast_cmd))
+        with stage(stage_name, inputs=[qry], outputs=[out_blast]):
+            stat = run_job(blast_cmd, log=log_file)
+        _check_job(stat, prog, log_file)
     else:
-        db_type = "prot"
-    idx_cmd = "makeblastdb -in %s -dbtype %s -out blastdb &> makeblastdb.log"%(ref, db_type)
-    if num_aln != "":
-        num_aln_cmd = " -num_alignments %s "%num_aln
+        bed1, bed2, iden_threshold, cov_threshold = blast_filter
+        print("Running blast with filter: %s" % ' '.join(blast_cmd))
+        cnt_list = []
+        with stage(stage_name, inputs=[qry], outputs=[out_blast]) as record:
+            with open_file(out_blast, 'w', threads) as fout:
+                stat = run_job(blast_cmd, log=log_file,
+                               stdout=lambda fin: cnt_list.extend(
+                                   filter_blast(fin, fout, bed1, bed2, iden_threshold, cov_threshold, catalog)))
+            if len(cnt_list) != 0:
+                record['kept'], record['hits'] = cnt_list
+        _check_job(stat, prog, log_file)
+        print("Kept %d of %d hits" % tuple(cnt_list))
+
+
+def run_exact_blast(blast_cmd, qry, ref, out_blast, threads, blast_filter, work_dir, shards, stage_name,
+                    catalog=None):
+    # Only blast the queries could not be resolved by the hashes of sequences, see plan_exact_blast. The hits of
+    # all queries are written to out_blast with the order of query, and filtered with blast_filter after the hits
+    # of identical queries are copied
+    ref_list = []
+    if ref != qry:
+        ref_list = ref if isinstance(ref, list) else [ref]
+    with stage("exact_hash", inputs=[qry] + ref_list) as record:
+        plan = plan_exact_blast(qry, ref_list, work_dir)
+        record['genes'] = len(plan['names'])
+        record['resolved'] = len(plan['resolved'])
+        record['identical'] = len(plan['reps'])
+    print("Resolved %d queries with identical references, %d with identical queries, %d of %d queries left" % (
+        len(plan['resolved']), len(plan['reps']), plan['seqs'], len(plan['names'])))
+
+    exact_blast = os.path.join(work_dir, "exact_qry.blast")
+    if plan['seqs'] != 0:
+        blast_cmd = blast_cmd[:]
+        blast_cmd[blast_cmd.index("-query") + 1] = plan['query']
+        _search_blast(blast_cmd, plan['query'], exact_blast, threads, None, work_dir, shards, stage_name)
     else:
-        num_aln_cmd = ""
-    blast_cmd = "%s -query %s -db blastdb -out %s -evalue %s -outfmt %s %s -num_threads %s &> blast.log"%(prog, qry, out_blast, evalue, fmt, num_aln_cmd, threads)
+        open(exact_blast, 'w').close()
 
-    print("Running makeblastdb: %s"%idx_cmd)
-    ret = os.system(idx_cmd)
-    if ret != 0:
-        print("Fatal error, makeblastdb failed")
-        exit(-1)
-    print("Running blast: %s"%blast_cmd)
-    ret = os.system(blast_cmd)
-    if ret != 0:
-        print("Fatal error, blast failed")
-        exit(-1)
+    with open_file(out_blast, 'w', threads) as fout:
+        if blast_filter is None:
+            fout.writelines(iter_exact_hits(plan, exact_blast))
+        else:
+            bed1, bed2, iden_threshold, cov_threshold = blast_filter
+            print("Kept %d of %d hits" % filter_blast(iter_exact_hits(plan, exact_blast), fout, bed1, bed2,
+                                                      iden_threshold, cov_threshold, catalog))
+    os.remove(plan['query'])
+    os.remove(exact_blast)
+
+
+def run_blast(qry, ref, prog, evalue, fmt, num_aln, out_blast, threads, blast_filter=None, db="", work_dir=".",
+              shards=1, exact_hash=False, catalog_file=""):
+    # blast_filter is None or a list of [bed1, bed2, iden_threshold, cov_threshold], if it is set,
+    # the output of blast would be filtered through a pipe before writing to out_blast, with the gene catalog of
+    # the run in catalog_file, or the catalog built from bed1 and bed2 if catalog_file is empty.
+    # ref could be a fasta file or a list of fasta files, db is a blast db built before,
+    # if it is set, ref would only be used by exact_hash.
+    # If shards is more than 1, the query is split into shards with balanced length, and the blasts of shards run
+    # at the same time, the hits are merged with the order of query, only work with format 6.
+    # If exact_hash is True, the queries identical with reference or previous queries are not searched, and get
+    # synthetic or copied hits instead, only work with blastn and format 6.
+    # The blast db and logs are written to work_dir.
+    # out_blast is compressed if it ends with .gz or .zst, and compressed query and reference are decompressed to
+    # work_dir since blast only reads plain fasta
+    if not os.path.exists(work_dir):
+        os.makedirs(work_dir)
+    # Blast of query with itself is recorded as self_blast
+    stage_name = "blast"
+    if ref == qry:
+        stage_name = "self_blast"
+    plain_list = []
+    plain_qry = get_plain_file(qry, os.path.join(work_dir, "plain_qry.fa"))
+    plain_list.append([qry, plain_qry])
+    if ref == qry:
+        ref = plain_qry
+    elif db == "" or exact_hash:
+        ref_list = ref if isinstance(ref, list) else [ref]
+        plain_ref_list = []
+        for idx in range(len(ref_list)):
+            plain_ref_list.append(get_plain_file(ref_list[idx], os.path.join(work_dir, "plain_ref%d.fa" % idx)))
+            plain_list.append([ref_list[idx], plain_ref_list[-1]])
+        ref = plain_ref_list if isinstance(ref, list) else plain_ref_list[0]
+    qry = plain_qry
+
+    if db == "":
+        # Make blast db
+        db = os.path.join(work_dir, "blastdb")
+        make_blast_db(ref, prog, db)
+    blast_cmd = [prog, "-query", qry, "-db", db, "-evalue", str(evalue), "-outfmt", str(fmt)]
+    if num_aln != "":
+        blast_cmd.extend(["-num_alignments", str(num_aln)])
+
+    # The catalog is loaded once and shared by the filters of all shards
+    catalog = None
+    if blast_filter is not None and catalog_file != "":
+        catalog = load_gene_catalog(catalog_file)
+    if exact_hash:
+        run_exact_blast(blast_cmd, qry, ref, out_blast, threads, blast_filter, work_dir, shards, stage_name, catalog)
+    else:
+        _search_blast(blast_cmd, qry, out_blast, threads, blast_filter, work_dir, shards, stage_name, catalog)
+    if catalog is not None:
+        catalog.close()
+    for in_file, plain_file in plain_list:
+        if plain_file != in_file:
+            os.remove(plain_file)
     print("Finished")
 
 
+def _run_blast_job(qry, ref, prog, evalue, fmt, num_aln, out_blast, threads, work_dir, blast_filter, shards,
+                   exact_hash, catalog_file):
+    # Each job owns its working directory, so the blastdb and logs of jobs running together never collide
+    run_blast(qry, ref, prog, evalue, fmt, num_aln, out_blast, threads, blast_filter, work_dir=work_dir,
+              shards=shards, exact_hash=exact_hash, catalog_file=catalog_file)
+    return out_blast
+
+
+def submit_blast_jobs(executor, jobs, threads, shards=1, exact_hash=False, catalog_file=""):
+    # jobs is a dict of key -> [qry, ref, prog, evalue, fmt, num_aln, out_blast, work_dir, blast_filter],
+    # threads is the threads of each job, shards, exact_hash and catalog_file are passed to run_blast, the executor
+    # is a process pool shared with other jobs.
+    # The key is recorded as iteration of the stages in metrics.
+    # Return a dict of key -> future, caller should call result() on futures
+    futures = {}
+    for key in jobs:
+        qry, ref, prog, evalue, fmt, num_aln, out_blast, work_dir, blast_filter = jobs[key]
+        futures[key] = executor.submit(call_with_context, {'iteration': key}, _run_blast_job, qry, ref, prog, evalue,
+                                       fmt, num_aln, out_blast, threads, work_dir, blast_filter, shards,
+                                       exact_hash, catalog_file)
+    return futures
+
+
 if __name__ == "__main__":
     opts = get_opts()
     qry = opts.query
@@ -52,4 +341,8 @@ if __name__ == "__main__":
     num_aln = opts.num_alignment
     out_blast = opts.output
     threads = opts.thread
-    run_blast(qry, ref, prog, evalue, fmt, num_aln, out_blast, threads)
+    blast_filter = None
+    if opts.filter_bed is not None:
+        blast_filter = [opts.filter_bed[0], opts.filter_bed[1], opts.iden, opts.coverage]
+    run_blast(qry, ref, prog, evalue, fmt, num_aln, out_blast, threads, blast_filter, shards=opts.shards,
+              exact_hash=opts.exact_hash)
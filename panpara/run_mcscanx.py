@@ -1,6 +1,11 @@
 #!/usr/bin/env python
 import os
 import argparse
+import shutil
+from array import array
+from .compress import open_file, get_file_compress
+from .job_runner import run_job
+from .metrics import stage
 
 
 # get_best_match_table(bed1, bed2, tbl, blast, blast2, iden_threshold, cov_threshold, outdir)
@@ -17,57 +22,144 @@ def get_opts():
     return groups.parse_args()
 
 
-def load_bed(bed, bed_list):
-    with open(bed, 'r') as fin:
-        for line in fin:
-            data = line.strip().split()
-            bed_list.append([data[0][-3:], data[3], data[1], data[2]])
+def get_gff_line(chrn, sp, ep, gn):
+    return "%s\t%s\t%s\t%s\n" % (chrn[-3:], gn, sp, ep)
 
 
-def load_blast(blast, blast_list):
-    with open(blast, 'r') as fin:
+def write_gff(bed, fout):
+    with open_file(bed, 'r') as fin:
         for line in fin:
-            blast_list.append(line.strip())
-
-
-def run_mcscanx(bed1, bed2, blast1, blast2, out_dir):
+            data = line.strip().split()
+            fout.write(get_gff_line(data[0], data[1], data[2], data[3]))
+
+
+def write_blast(blast, fout):
+    # Copy blast file with chunks, and make sure the file is ended with line break, compressed blast file is
+    # decompressed since MCScanX only reads plain text
+    last = b''
+    with open_file(blast, 'rb') as fin:
+        while True:
+            chunk = fin.read(1 << 24)
+            if not chunk:
+                break
+            fout.write(chunk)
+            last = chunk[-1:]
+    if last not in (b'', b'\n'):
+        fout.write(b'\n')
+
+
+def link_blast(blast, m_blast):
+    # Link blast file to m_blast instead of copying it, if link is not supported or blast file is compressed,
+    # copy it
+    if os.path.lexists(m_blast):
+        os.remove(m_blast)
+    if get_file_compress(blast) != "":
+        with open(m_blast, 'wb') as fout:
+            write_blast(blast, fout)
+        return
+    try:
+        os.symlink(os.path.abspath(blast), m_blast)
+    except OSError:
+        with open(m_blast, 'wb') as fout:
+            write_blast(blast, fout)
+
+
+def run_mcscanx(bed1, bed2, blast1, blast2, out_dir, id_db_list=None, gff1=""):
+    # If id_db_list is None, return dict of gene name -> highest score of collinearity blocks.
+    # Otherwise, id_db_list is a list of dict of gene name -> gene index, and for each dict, return an array
+    # indexed by gene index with the highest score of collinearity blocks, the genes not in any block are 1.0.
+    # gff1 is the gff of bed1 written before, it is copied instead of converting bed1 again
     if not os.path.exists(out_dir):
         os.makedirs(out_dir)
 
-    print("Loading bed")
-    bed_list = []
-    load_bed(bed1, bed_list)
-    if bed1 != bed2:
-        load_bed(bed2, bed_list)
-
-    print("Loading blast")
-    blast_list = []
-    load_blast(blast1, blast_list)
-    if bed1 != bed2:
-        load_blast(blast2, blast_list)
-
     m_pre = out_dir + "/xyz"
     m_gff = m_pre + '.gff'
     m_blast = m_pre + '.blast'
 
     print("Writing gff and blast")
     with open(m_gff, 'w') as fout:
-        for info in bed_list:
-            fout.write("%s\n" % ('\t'.join(info)))
+        if gff1 != "":
+            with open(gff1, 'r') as fin:
+                shutil.copyfileobj(fin, fout, 1 << 24)
+        else:
+            write_gff(bed1, fout)
+        if bed1 != bed2:
+            write_gff(bed2, fout)
 
-    with open(m_blast, 'w') as fout:
-        fout.write("%s\n" % ('\n'.join(blast_list)))
+    if bed1 != bed2:
+        with open(m_blast, 'wb') as fout:
+            write_blast(blast1, fout)
+            write_blast(blast2, fout)
+    else:
+        link_blast(blast1, m_blast)
 
     print("Running MCScanX")
-    cmd = "MCScanX " + m_pre
-    print("\tRunning: %s" % cmd)
-    ret = os.system(cmd)
-    if ret != 0:
-        print("Fatal error, MCScanX failed")
+    cmd = ["MCScanX", m_pre]
+    log_file = m_pre + ".log"
+    if os.path.exists(log_file):
+        os.remove(log_file)
+    print("\tRunning: %s" % ' '.join(cmd))
+    with stage("mcscanx", inputs=[m_gff, m_blast], outputs=[m_pre + ".collinearity"]):
+        stat = run_job(cmd, log=log_file)
+    if stat['status'] != "ok":
+        print("Fatal error, MCScanX %s with exit code %d, see %s" % (stat['status'], stat['returncode'], log_file))
         exit(-1)
+    # The plain copy of compressed blast files is only used by MCScanX
+    if get_file_compress(blast1) != "" or get_file_compress(blast2) != "":
+        os.remove(m_blast)
 
     col_file = m_pre + ".collinearity"
-    col_db = {}
+    if id_db_list is None:
+        col_db = {}
+        for id1, id2, score in read_collinearity(col_file):
+            if id1 not in col_db or col_db[id1] < score:
+                col_db[id1] = score
+            if id2 not in col_db or col_db[id2] < score:
+                col_db[id2] = score
+        print("Finished")
+        return col_db
+
+    col_list = []
+    seen_list = []
+    for id_db in id_db_list:
+        col_list.append(array('d', [1.0]) * len(id_db))
+        seen_list.append(bytearray(len(id_db)))
+    for id1, id2, score in read_collinearity(col_file):
+        for id_db, col_scores, seen in zip(id_db_list, col_list, seen_list):
+            for gn in (id1, id2):
+                idx = id_db.get(gn)
+                if idx is None:
+                    continue
+                if not seen[idx] or col_scores[idx] < score:
+                    col_scores[idx] = score
+                    seen[idx] = 1
+    print("Finished")
+    return col_list
+
+
+def run_self_mcscanx(bed, blast, out_dir, id_db, cache_file=""):
+    # The collinearity scores of self comparison only depend on the sample, so they are saved to cache_file as
+    # an array indexed by gene index, and loaded from it if it exists, cache_file is ignored if it is empty
+    if cache_file != "" and os.path.exists(cache_file) and os.path.getsize(cache_file) == len(id_db) * 8:
+        print("Loading collinearity scores from %s" % cache_file)
+        col_scores = array('d')
+        with open(cache_file, 'rb') as fin:
+            col_scores.fromfile(fin, len(id_db))
+        return col_scores
+
+    col_scores = run_mcscanx(bed, bed, blast, blast, out_dir, [id_db])[0]
+    if cache_file != "":
+        cache_dir = os.path.dirname(os.path.abspath(cache_file))
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        with open(cache_file + ".tmp", 'wb') as fout:
+            col_scores.tofile(fout)
+        os.replace(cache_file + ".tmp", cache_file)
+    return col_scores
+
+
+def read_collinearity(col_file):
+    # Yield gene pairs and the score of collinearity block they belong to
     with open(col_file, 'r') as fin:
         for line in fin:
             if line[0] == '#':
@@ -75,15 +167,7 @@ def run_mcscanx(bed1, bed2, blast1, blast2, out_dir):
                     score = float(line.strip().split()[3].split('=')[1])
             else:
                 data = line.strip().split()
-                id1 = data[2]
-                id2 = data[3]
-                if id1 not in col_db or col_db[id1] < score:
-                    col_db[id1] = score
-                if id2 not in col_db or col_db[id2] < score:
-                    col_db[id2] = score
-
-    print("Finished")
-    return col_db
+                yield data[2], data[3], score
 
 
 if __name__ == "__main__":
@@ -0,0 +1,177 @@
+import json
+import os
+import zlib
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from .compress import open_file
+from .metrics import stage, call_with_context
+from .step_cache import get_step_key
+
+
+# Binary file of sketch of a sample:
+#   magic line
+#   header line, json of counts of genes and hashes, size of k-mer and scale
+#   offsets of hashes of genes, an array of count of genes + 1 values of 8 bytes
+#   hashes of k-mers of all genes, an array of 8 bytes values, the hashes of each gene are sorted
+_magic = b"PANPARA_SKETCH_1\n"
+_kmer_size = 21
+# About one in scale k-mers is kept in the sketch of genes
+_scale = 32
+# The sketches of samples used for ordering keep one in order_scale hashes of sketches of genes
+_order_scale = 16
+
+
+def read_fasta_seqs(in_fa):
+    # Yield name and upper case sequence of records of in_fa, the sequence is bytes
+    with open_file(in_fa, 'rb') as fin:
+        name = None
+        seq_lines = []
+        for line in fin:
+            if line[:1] == b'>':
+                if name is not None:
+                    yield name, b''.join(seq_lines).upper()
+                name = line.strip()[1:].decode()
+                seq_lines = []
+            else:
+                seq_lines.append(line.strip())
+        if name is not None:
+            yield name, b''.join(seq_lines).upper()
+
+
+def get_gene_hashes(seq, kmer_size, max_hash):
+    # Return sorted hashes of the k-mers of seq kept by FracMinHash. A k-mer is kept if its crc32 is less than
+    # max_hash, and its hash is crc32 and adler32 joined as a 64 bits integer, so the hashes kept with a smaller
+    # max_hash are a subset of them. The cds are on coding strand, so the reverse complement is not used
+    crc32 = zlib.crc32
+    adler32 = zlib.adler32
+    hashes = set()
+    for i in range(len(seq) - kmer_size + 1):
+        kmer = seq[i: i + kmer_size]
+        kmer_hash = crc32(kmer)
+        if kmer_hash < max_hash:
+            hashes.add((kmer_hash << 32) | adler32(kmer))
+    return sorted(hashes)
+
+
+def build_sketch(in_fa, out_file, kmer_size=_kmer_size, scale=_scale):
+    # Read in_fa once and save the hashes of k-mers of each gene to out_file
+    with stage("sketch", inputs=[in_fa], outputs=[out_file]) as record:
+        max_hash = (1 << 32) // scale
+        offsets = array('q', [0])
+        hashes = array('Q')
+        for _, seq in read_fasta_seqs(in_fa):
+            hashes.extend(get_gene_hashes(seq, kmer_size, max_hash))
+            offsets.append(len(hashes))
+        record['genes'] = len(offsets) - 1
+        record['hashes'] = len(hashes)
+        header = {'genes': len(offsets) - 1, 'hashes': len(hashes), 'kmer_size': kmer_size, 'scale': scale}
+        # Write to a temporary file first, so that a broken sketch is never loaded
+        with open(out_file + ".tmp", 'wb') as fout:
+            fout.write(_magic)
+            fout.write(json.dumps(header).encode() + b'\n')
+            offsets.tofile(fout)
+            hashes.tofile(fout)
+        os.replace(out_file + ".tmp", out_file)
+    return out_file
+
+
+def load_sketch(in_file):
+    # Return offsets and hashes of genes, the hashes of gene i are hashes[offsets[i]: offsets[i + 1]]
+    with open(in_file, 'rb') as fin:
+        if fin.readline() != _magic:
+            print("Fatal error, %s is not a sketch" % in_file)
+            exit(-1)
+        header = json.loads(fin.readline())
+        offsets = array('q')
+        offsets.fromfile(fin, header['genes'] + 1)
+        hashes = array('Q')
+        hashes.fromfile(fin, header['hashes'])
+    return offsets, hashes
+
+
+def get_greedy_order(set_list, gene_cnt_list, start):
+    # Add samples to reference one by one from start, the next sample is the one with the least predicted new
+    # genes, which is its count of genes multiplied by the fraction of its hashes not in reference.
+    # Return the order and its cost, the sum of predicted reference sizes after each sample, since the blast of
+    # each iteration searches the reference of previous iteration
+    novel_list = [set(hash_set) for hash_set in set_list]
+    remaining = set(range(len(set_list)))
+    order = []
+    ref_size = 0.0
+    cost = 0.0
+    idx = start
+    while True:
+        order.append(idx)
+        remaining.discard(idx)
+        new_hashes = novel_list[idx]
+        ref_size += gene_cnt_list[idx] * len(new_hashes) / max(1, len(set_list[idx]))
+        cost += ref_size
+        if len(remaining) == 0:
+            break
+        for smp_idx in remaining:
+            novel_list[smp_idx].difference_update(new_hashes)
+        idx = min(remaining, key=lambda x: (gene_cnt_list[x] * len(novel_list[x]) / max(1, len(set_list[x])), x))
+    return order, cost
+
+
+def predict_ref_sizes(sketch_list):
+    # Predict the count of reference genes after each sample in the order of sketch_list. A gene is added to
+    # reference if it shares no k-mer with the genes in reference, include the genes of the same sample added
+    # before it, like the paralogs of new genes are clustered. Genes without any kept k-mer are added with the
+    # rate of other genes of the sample
+    ref_hashes = set()
+    ref_size = 0.0
+    size_list = []
+    for offsets, hashes in sketch_list:
+        new_cnt = 0
+        known_cnt = 0
+        empty_cnt = 0
+        for idx in range(len(offsets) - 1):
+            gene_hashes = hashes[offsets[idx]: offsets[idx + 1]]
+            if len(gene_hashes) == 0:
+                empty_cnt += 1
+            elif ref_hashes.isdisjoint(gene_hashes):
+                ref_hashes.update(gene_hashes)
+                new_cnt += 1
+            else:
+                known_cnt += 1
+        ref_size += new_cnt + empty_cnt * new_cnt / max(1, new_cnt + known_cnt)
+        size_list.append(ref_size)
+    return size_list
+
+
+def plan_sample_order(sample_list, cds_list, plan_dir, threads, pin_ref=False):
+    # Choose the order of samples which keeps the reference small in early iterations with the sketches of cds of
+    # samples, cds_list is the cds files of sample_list. If pin_ref is True, the first sample is kept as reference,
+    # otherwise the orders from every sample are tried and the one with the least cost is chosen.
+    # The sketches are saved in plan_dir with the keys of cds files, the plan is written to plan_dir/order.tsv.
+    # Return the ordered samples and the predicted reference sizes after each iteration
+    if not os.path.exists(plan_dir):
+        os.makedirs(plan_dir)
+    sketch_list = []
+    jobs = {}
+    for smp, cds in zip(sample_list, cds_list):
+        sketch_file = os.path.join(plan_dir, "%s.sketch" % get_step_key([cds], [_kmer_size, _scale]))
+        sketch_list.append(sketch_file)
+        if not os.path.exists(sketch_file):
+            jobs[smp] = [cds, sketch_file]
+    if len(jobs) != 0:
+        with ProcessPoolExecutor(max_workers=max(1, min(len(jobs), int(threads)))) as pool:
+            futures = [pool.submit(call_with_context, {'sample': smp}, build_sketch, *jobs[smp]) for smp in jobs]
+            for future in futures:
+                future.result()
+    sketch_list = [load_sketch(sketch_file) for sketch_file in sketch_list]
+
+    gene_cnt_list = [len(offsets) - 1 for offsets, _ in sketch_list]
+    max_hash = ((1 << 32) // _scale // _order_scale) << 32
+    set_list = [set(kmer_hash for kmer_hash in hashes if kmer_hash < max_hash) for _, hashes in sketch_list]
+    start_list = [0] if pin_ref else range(len(sample_list))
+    order, _ = min([get_greedy_order(set_list, gene_cnt_list, start) for start in start_list], key=lambda x: x[1])
+    size_list = predict_ref_sizes([sketch_list[idx] for idx in order])
+
+    with open(os.path.join(plan_dir, "order.tsv"), 'w') as fout:
+        fout.write("#iteration\tsample\tgenes\tpredicted_ref\n")
+        for iter in range(len(order)):
+            fout.write("%d\t%s\t%d\t%d\n" % (iter + 1, sample_list[order[iter]], gene_cnt_list[order[iter]],
+                                             round(size_list[iter])))
+    return [sample_list[idx] for idx in order], size_list
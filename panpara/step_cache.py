@@ -0,0 +1,79 @@
+import hashlib
+import json
+import os
+
+
+# Hashes of files computed in this run, key is (path, size, mtime)
+_file_hash_db = {}
+
+
+def get_file_hash(in_file):
+    # Get sha1 of file content, the hashes of unchanged files are reused in the same run
+    stat = os.stat(in_file)
+    file_key = (os.path.abspath(in_file), stat.st_size, stat.st_mtime)
+    if file_key not in _file_hash_db:
+        sha = hashlib.sha1()
+        with open(in_file, 'rb') as fin:
+            while True:
+                buf = fin.read(1 << 20)
+                if not buf:
+                    break
+                sha.update(buf)
+        _file_hash_db[file_key] = sha.hexdigest()
+    return _file_hash_db[file_key]
+
+
+def get_step_key(file_list, param_list):
+    # The key of a step is the hash of its input files and parameters, keys of upstream steps could be
+    # used as parameters instead of hashing their large outputs
+    info = [get_file_hash(in_file) for in_file in file_list]
+    info.extend(map(str, param_list))
+    return hashlib.sha1('\n'.join(info).encode()).hexdigest()
+
+
+def get_blast_key(file_list, blast_filter, exact_hash=False, bed_key_list=None):
+    # Key of the blastn step used by both linear and tree mode, file_list is the fasta files of query and reference.
+    # Thresholds only change the blast result when blast hits are filtered. bed_key_list is the files hashed
+    # instead of the beds of blast_filter, for a bed which is appended in place
+    param_list = ['blastn', '1e-3', '6']
+    if exact_hash:
+        param_list.append('exact_hash')
+    if blast_filter is None:
+        return get_step_key(file_list, param_list)
+    if bed_key_list is None:
+        bed_key_list = blast_filter[:2]
+    return get_step_key(file_list + bed_key_list, param_list + blast_filter[2:])
+
+
+def load_manifest(work_dir):
+    manifest = os.path.join(work_dir, "manifest.json")
+    if not os.path.exists(manifest):
+        return {}
+    with open(manifest, 'r') as fin:
+        return json.load(fin)
+
+
+def save_manifest(work_dir, manifest_db):
+    # Write to a temporary file first, so that the manifest is never broken when the pipeline is killed
+    manifest = os.path.join(work_dir, "manifest.json")
+    with open(manifest + ".tmp", 'w') as fout:
+        json.dump(manifest_db, fout, indent=1, sort_keys=True)
+    os.replace(manifest + ".tmp", manifest)
+
+
+def is_step_done(work_dir, step, key, out_list=()):
+    # Check whether the step was finished with the same key and all outputs exist,
+    # if not, the record of the step is removed, so that a broken rerun never looks finished
+    manifest_db = load_manifest(work_dir)
+    if manifest_db.get(step) == key and all(os.path.exists(out_file) for out_file in out_list):
+        return True
+    if step in manifest_db:
+        manifest_db.pop(step)
+        save_manifest(work_dir, manifest_db)
+    return False
+
+
+def set_step_done(work_dir, step, key):
+    manifest_db = load_manifest(work_dir)
+    manifest_db[step] = key
+    save_manifest(work_dir, manifest_db)
@@ -0,0 +1,146 @@
+import os
+from .compress import find_input_file, get_compress_suffix
+from .gene_catalog import load_gene_catalog
+from .get_best_match_table import get_best_match_table
+from .get_cds_with_bed import get_seq_with_list
+from .merge_para_table import merge_para_tables
+from .metrics import stage
+from .run_blast import run_blast
+from .step_cache import get_step_key, get_blast_key, is_step_done, set_step_done, load_manifest
+
+
+def get_merge_tree(sample_list):
+    # Pair adjacent nodes level by level until only one node left, the last node of a level with odd nodes is
+    # moved to next level directly, so the samples of each node are a continuous range of sample_list.
+    # Return list of nodes, children are always before their parents, and the last one is the root. Each node is a
+    # dict with name, samples, and children, children is the list of indices of two child nodes, or empty for leaf
+    node_list = []
+    level_list = []
+    for smp in sample_list:
+        node_list.append({'name': "leaf_%s" % smp, 'samples': [smp], 'children': []})
+        level_list.append(len(node_list) - 1)
+    level = 1
+    while len(level_list) > 1:
+        next_level_list = []
+        for i in range(0, len(level_list) - 1, 2):
+            left, right = level_list[i], level_list[i + 1]
+            smp_list = node_list[left]['samples'] + node_list[right]['samples']
+            node_list.append({'name': "merge%d_%s_%s" % (level, smp_list[0], smp_list[-1]), 'samples': smp_list,
+                              'children': [left, right]})
+            next_level_list.append(len(node_list) - 1)
+        if len(level_list) % 2 == 1:
+            next_level_list.append(level_list[-1])
+        level_list = next_level_list
+        level += 1
+    return node_list
+
+
+def write_ref_cds(node_dir, cds_dir, match_dir, compress="", smp_list=None):
+    # Write cds of reference genes of the node to match/ref.cds, with the suffix of compress if it is compressed,
+    # smp_list is the samples of the node, default is all samples in cds_dir
+    ref_bed = os.path.join(match_dir, "ref.bed")
+    ref_cds = os.path.join(match_dir, "ref.cds" + get_compress_suffix(compress))
+    refcds_key = get_step_key([ref_bed], [load_manifest(node_dir).get("match")])
+    if not is_step_done(node_dir, "refcds", refcds_key, [ref_cds]):
+        get_seq_with_list(cds_dir, ref_bed, ref_cds, smp_list)
+        set_step_done(node_dir, "refcds", refcds_key)
+
+
+def run_tree_leaf(smp, cds_dir, bed_dir, iden, cov, node_dir, threads, prefilter=False, catalog_file="", shards=1,
+                  exact_hash=False, max_memory=0, compress=""):
+    # Construct paralog table of one sample with its self comparison, the same as the first iteration of pan_para.
+    # catalog_file is the gene catalog of all samples, it is built from the bed of sample if it is empty.
+    # shards is the count of query shards of each blast running at the same time, exact_hash resolves the genes
+    # identical with reference or previous query genes without blast, max_memory is the MB of memory could be used
+    # by blast hits. compress is the method of compressing blast outputs and reference cds, "gzip" or "zstd".
+    # Return the directory of paralog table
+    if not os.path.exists(node_dir):
+        os.makedirs(node_dir)
+    suffix = get_compress_suffix(compress)
+    cds = find_input_file(os.path.join(cds_dir, "%s.cds" % smp))
+    bed = find_input_file(os.path.join(bed_dir, "%s.bed" % smp))
+    blast_file = os.path.join(node_dir, "self.blast" + suffix)
+    blast_filter = None
+    if prefilter:
+        blast_filter = [bed, bed, iden, cov]
+    blast_key = get_blast_key([cds], blast_filter, exact_hash)
+    if not is_step_done(node_dir, "blast", blast_key, [blast_file]):
+        run_blast(cds, cds, 'blastn', '1e-3', '6', '', blast_file, threads, blast_filter, work_dir=node_dir,
+                  shards=shards, exact_hash=exact_hash, catalog_file=catalog_file)
+        set_step_done(node_dir, "blast", blast_key)
+
+    match_dir = os.path.join(node_dir, "match")
+    match_key = get_step_key([bed], [blast_key, iden, cov])
+    match_out_list = [os.path.join(match_dir, "para.tbl"), os.path.join(match_dir, "ref.bed")]
+    if not is_step_done(node_dir, "match", match_key, match_out_list):
+        with stage("best_match", inputs=[bed, blast_file], profile=True):
+            catalog = None
+            if catalog_file != "":
+                catalog = load_gene_catalog(catalog_file)
+            get_best_match_table(bed, bed, '', blast_file, '', iden, cov, match_dir, catalog=catalog,
+                                 max_memory=max_memory)
+            if catalog is not None:
+                catalog.close()
+        set_step_done(node_dir, "match", match_key)
+    write_ref_cds(node_dir, cds_dir, match_dir, compress, [smp])
+    return match_dir
+
+
+def run_tree_merge(cds_dir, match_dir1, match_dir2, iden, cov, node_dir, threads, prefilter=False, catalog_file="",
+                   shards=1, exact_hash=False, max_memory=0, compress="", smp_list=None):
+    # Merge paralog tables of two nodes, the reference genes of second node are compared with the reference genes of
+    # first node and themselves, like the sample in an iteration of pan_para.
+    # catalog_file is the gene catalog of all samples, it is built from the reference genes if it is empty.
+    # shards is the count of query shards of each blast running at the same time, exact_hash resolves the genes
+    # identical with reference or previous query genes without blast, max_memory is the MB of memory could be used
+    # by blast hits. compress is the method of compressing blast outputs and reference cds, "gzip" or "zstd".
+    # smp_list is the samples of both nodes, only their cds are read for the reference genes.
+    # Return the directory of paralog table
+    if not os.path.exists(node_dir):
+        os.makedirs(node_dir)
+    suffix = get_compress_suffix(compress)
+    ref_bed1 = os.path.join(match_dir1, "ref.bed")
+    ref_bed2 = os.path.join(match_dir2, "ref.bed")
+    ref_cds1 = os.path.join(match_dir1, "ref.cds" + suffix)
+    ref_cds2 = os.path.join(match_dir2, "ref.cds" + suffix)
+
+    blast_file = os.path.join(node_dir, "cross.blast" + suffix)
+    blast_filter = None
+    if prefilter:
+        blast_filter = [ref_bed1, ref_bed2, iden, cov]
+    blast_key = get_blast_key([ref_cds2, ref_cds1], blast_filter, exact_hash)
+    if not is_step_done(node_dir, "blast", blast_key, [blast_file]):
+        run_blast(ref_cds2, ref_cds1, 'blastn', '1e-3', '6', '', blast_file, threads, blast_filter,
+                  work_dir=os.path.join(node_dir, "cross"), shards=shards, exact_hash=exact_hash,
+                  catalog_file=catalog_file)
+        set_step_done(node_dir, "blast", blast_key)
+
+    self_blast_file = os.path.join(node_dir, "self.blast" + suffix)
+    self_blast_filter = None
+    if prefilter:
+        self_blast_filter = [ref_bed2, ref_bed2, iden, cov]
+    self_blast_key = get_blast_key([ref_cds2], self_blast_filter, exact_hash)
+    if not is_step_done(node_dir, "self_blast", self_blast_key, [self_blast_file]):
+        run_blast(ref_cds2, ref_cds2, 'blastn', '1e-3', '6', '', self_blast_file, threads, self_blast_filter,
+                  work_dir=os.path.join(node_dir, "self"), shards=shards, exact_hash=exact_hash,
+                  catalog_file=catalog_file)
+        set_step_done(node_dir, "self_blast", self_blast_key)
+
+    # The tables of children are determined by their match keys
+    match_dir = os.path.join(node_dir, "match")
+    match_key = get_step_key([], [blast_key, self_blast_key, load_manifest(os.path.dirname(match_dir1)).get("match"),
+                                  load_manifest(os.path.dirname(match_dir2)).get("match"), iden, cov])
+    match_out_list = [os.path.join(match_dir, "para.tbl"), os.path.join(match_dir, "ref.bed")]
+    if not is_step_done(node_dir, "match", match_key, match_out_list):
+        with stage("best_match", inputs=[ref_bed1, ref_bed2, blast_file, self_blast_file], profile=True):
+            catalog = None
+            if catalog_file != "":
+                catalog = load_gene_catalog(catalog_file)
+            merge_para_tables(ref_bed1, ref_bed2, os.path.join(match_dir1, "para.tbl"),
+                              os.path.join(match_dir2, "para.tbl"), blast_file, self_blast_file, iden, cov,
+                              match_dir, catalog, max_memory)
+            if catalog is not None:
+                catalog.close()
+        set_step_done(node_dir, "match", match_key)
+    write_ref_cds(node_dir, cds_dir, match_dir, compress, smp_list)
+    return match_dir
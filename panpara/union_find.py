@@ -1,21 +1,55 @@
+from array import array
+
+
 class union_find:
+    # Parents and component sizes are kept in integer arrays, smaller component is always attached under larger one
     def __init__(self, n):
-        self._f = [_ for _ in range(n)]
-    
+        self._f = array('l', range(n))
+        self._size = array('l', [1]) * n
+
     def find(self, x):
+        f = self._f
         t = x
-        while t != self._f[t]:
-            t = self._f[t]
-        while x != self._f[x]:
-            tmp = self._f[x]
-            self._f[x] = t
+        while t != f[t]:
+            t = f[t]
+        while x != f[x]:
+            tmp = f[x]
+            f[x] = t
             x = tmp
-        return self._f[x]
-    
+        return t
+
     def union(self, x, y):
         fx = self.find(x)
         fy = self.find(y)
         if fx != fy:
+            if self._size[fx] < self._size[fy]:
+                fx, fy = fy, fx
             self._f[fy] = fx
-    
-        
+            self._size[fx] += self._size[fy]
+
+    def union_many(self, edges):
+        # edges is an iterable of (x, y)
+        union = self.union
+        for x, y in edges:
+            union(x, y)
+
+    def components(self):
+        # Return labels of all nodes and count of components, labels are numbered with the order of
+        # the first node of each component
+        find = self.find
+        labels = array('l', [-1]) * len(self._f)
+        root_label = {}
+        for x in range(len(self._f)):
+            root = find(x)
+            if root not in root_label:
+                root_label[root] = len(root_label)
+            labels[x] = root_label[root]
+        return labels, len(root_label)
+
+    def groups(self):
+        # Return list of components, each component is the list of its nodes in ascending order
+        labels, cnt = self.components()
+        groups = [[] for _ in range(cnt)]
+        for x in range(len(labels)):
+            groups[labels[x]].append(x)
+        return groups